@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# raas - docker registry tooling that integrates with Pulp and Crane
+# Copyright (C) 2015  Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic docker image generator for load testing.
+
+Writes "docker save" (v1) tarballs: a "repositories" file plus "<id>/VERSION",
+"<id>/json" and "<id>/layer.tar" of every image. Every tag gets its own chain
+of layers on top of a shared base, base layers can be Red Hat images taken
+from "redhat/metadata" JSON files. The tarball is written as a stream and
+layer data is generated while writing, so multi-GB images need no memory
+(and can be piped to stdout).
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tarfile
+
+from argparse import ArgumentParser
+
+CHUNK_SIZE = 1048576
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1048576, 'G': 1073741824}
+CREATED = '2015-06-01T00:00:00.000000000Z'
+
+
+def parse_size(text):
+    """Parse size like "512K", "20M" or "2G" to bytes, bare number is bytes"""
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def redhat_image_ids(path):
+    """Image IDs listed in Red Hat metadata JSON file or dir of such files, in listed order"""
+    if os.path.isdir(path):
+        filenames = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.json')]
+    else:
+        filenames = [path]
+    ids = []
+    for filename in filenames:
+        with open(filename) as f:
+            ids.extend(image['id'] for image in json.load(f).get('images', []))
+    return ids
+
+
+def image_id(seed, *parts):
+    return hashlib.sha256('/'.join([seed] + [str(p) for p in parts])).hexdigest()
+
+
+class Image(object):
+    """Generated image: ID, parent ID and size of its layer data"""
+
+    def __init__(self, image_id, parent, size):
+        self.id = image_id
+        self.parent = parent
+        self.size = size
+
+    def json(self):
+        config = {'Hostname': '', 'Env': ['PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'],
+                  'Cmd': ['/bin/sh'], 'Image': self.parent or ''}
+        data = {'id': self.id, 'created': CREATED, 'container_config': config, 'config': config,
+                'docker_version': '1.6.0', 'architecture': 'amd64', 'os': 'linux', 'Size': self.size}
+        if self.parent:
+            data['parent'] = self.parent
+        return json.dumps(data)
+
+
+def plan_image(tags=('latest',), layers=5, sizes=(CHUNK_SIZE,), base_ids=(), base_layers=0, seed='raas'):
+    """Return list of images (parents first) and tag -> image ID mapping
+
+    Chain is base_ids (e.g. Red Hat images) followed by base_layers generated
+    shared layers, then every tag gets its own layers on top of that. Layer
+    sizes are taken from sizes in chain order, the last one repeats.
+    """
+    def size(position):
+        return sizes[min(position, len(sizes) - 1)]
+
+    images = []
+    parent = None
+    base = list(base_ids) + [image_id(seed, 'base', i) for i in range(base_layers)]
+    for i, base_id in enumerate(base):
+        images.append(Image(base_id, parent, size(i)))
+        parent = base_id
+    tagged = {}
+    for tag in tags:
+        tag_parent = parent
+        for i in range(layers):
+            layer_id = image_id(seed, 'tag', tag, i)
+            images.append(Image(layer_id, tag_parent, size(len(base) + i)))
+            tag_parent = layer_id
+        tagged[tag] = tag_parent
+    return images, tagged
+
+
+class LayerTar(object):
+    """File-like valid layer tar with one file of random data, generated while read"""
+
+    def __init__(self, image):
+        info = tarfile.TarInfo('data/' + image.id)
+        info.size = image.size
+        info.mtime = 1433116800
+        self._header = info.tobuf(tarfile.GNU_FORMAT)
+        padded = -image.size % tarfile.BLOCKSIZE
+        end = len(self._header) + image.size + padded + 2 * tarfile.BLOCKSIZE
+        self._trailer_size = padded + 2 * tarfile.BLOCKSIZE + (-end % tarfile.RECORDSIZE)
+        self._data_left = image.size
+        self.size = end + (-end % tarfile.RECORDSIZE)
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size
+        out = []
+        while size:
+            if self._header:
+                data = self._header[:size]
+                self._header = self._header[size:]
+            elif self._data_left:
+                data = os.urandom(min(size, self._data_left, CHUNK_SIZE))
+                self._data_left -= len(data)
+            elif self._trailer_size:
+                data = '\0' * min(size, self._trailer_size)
+                self._trailer_size -= len(data)
+            else:
+                break
+            out.append(data)
+            size -= len(data)
+        return ''.join(out)
+
+
+class StringReader(object):
+    def __init__(self, data):
+        self._data = data
+
+    def read(self, size=-1):
+        size = len(self._data) if size < 0 else size
+        data, self._data = self._data[:size], self._data[size:]
+        return data
+
+
+def write_image(fileobj, repo, images, tagged):
+    """Write docker save tarball of images to fileobj as a stream"""
+    tar = tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.GNU_FORMAT)
+    def add(name, reader, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = 1433116800
+        tar.addfile(info, reader)
+    try:
+        for image in images:
+            info = tarfile.TarInfo(image.id)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0755
+            tar.addfile(info)
+            add(image.id + '/VERSION', StringReader('1.0'), 3)
+            data = image.json()
+            add(image.id + '/json', StringReader(data), len(data))
+            layer = LayerTar(image)
+            add(image.id + '/layer.tar', layer, layer.size)
+        data = json.dumps({repo: tagged})
+        add('repositories', StringReader(data), len(data))
+    finally:
+        tar.close()
+
+
+def main():
+    parser = ArgumentParser(description='Generate "docker save" tarball of synthetic image for load testing')
+    parser.add_argument('output', metavar='IMAGE.tar',
+            help='output file, "-" writes to stdout')
+    parser.add_argument('-r', '--repo', default='example/app',
+            help='image repository, default is "example/app"')
+    parser.add_argument('-t', '--tag', action='append', dest='tags', metavar='TAG',
+            help='tag with its own chain of layers, can be repeated, default is "latest"')
+    parser.add_argument('-l', '--layers', type=int, default=5,
+            help='layers per tag, default is 5')
+    parser.add_argument('-s', '--layer-size', default='1M', metavar='SIZE[,SIZE...]',
+            help='layer sizes (with K, M or G suffix) in chain order from the base, '
+                 'the last one repeats, default is "1M"')
+    parser.add_argument('-b', '--base-layers', type=int, default=0,
+            help='generated layers shared by all tags, default is 0')
+    parser.add_argument('--redhat-metadata', metavar='PATH',
+            help='redhat/metadata JSON file or dir, its images are used as base of the chain')
+    parser.add_argument('--redhat-layers', type=int, metavar='N',
+            help='use only the first N images of --redhat-metadata')
+    parser.add_argument('--seed', default='raas',
+            help='seed of generated image IDs, default is "raas"')
+    parser.add_argument('--print-ids', action='store_true',
+            help='print repositories mapping and image IDs as JSON to stderr')
+    args = parser.parse_args()
+
+    base_ids = []
+    if args.redhat_metadata:
+        base_ids = redhat_image_ids(args.redhat_metadata)[:args.redhat_layers]
+    sizes = [parse_size(s) for s in args.layer_size.split(',')]
+    images, tagged = plan_image(args.tags or ['latest'], args.layers, sizes, base_ids, args.base_layers, args.seed)
+    if args.output == '-':
+        write_image(sys.stdout, args.repo, images, tagged)
+    else:
+        with open(args.output, 'wb') as f:
+            write_image(f, args.repo, images, tagged)
+    if args.print_ids:
+        json.dump({'repositories': {args.repo: tagged}, 'images': [i.id for i in images]}, sys.stderr, indent=2)
+        sys.stderr.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# raas - docker registry tooling that integrates with Pulp and Crane
+# Copyright (C) 2015  Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""End-to-end benchmark of raas with local stand-in backends.
+
+Starts a fake pulp v2 API, a fake S3 server and a fake openshift broker
+(with a bare local git repo as the crane app) on localhost, generates a
+docker image and runs raas "pulp-upload", "publish" and "status" against
+them. Wall time, bytes moved and requests of every backend are reported
+per stage.
+"""
+
+import BaseHTTPServer
+import errno
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import SocketServer
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+
+from argparse import ArgumentParser
+from tempfile import mkdtemp
+from urlparse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+import gen_image
+
+RAAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'raas.py')
+
+ISV = 'bench'
+APP = 'bench/app'
+BUCKET = 'bench-bucket'
+
+CONFIG = """[redhat]
+metadata_repo = file:///nonexistent/crane-metadata.git
+metadata_relpath = files/metadata
+
+[openshift]
+server_url = {openshift}
+app_git_url = https://github.com/pulp/crane
+app_git_branch = master
+cartridge = python-2.7
+token = token
+
+[aws]
+aws_access_key = key
+aws_secret_access_key = secret
+endpoint = {s3}
+
+[pulpserver]
+host = {pulp}
+username = username
+password = password
+verify_ssl = False
+fetch = {fetch}
+download_workers = {download_workers}
+
+[bench]
+openshift_domain = bench
+openshift_app = registry
+openshift_scale = True
+openshift_gear_size = small
+s3_bucket = {bucket}
+"""
+
+STAGES = [
+    ('pulp-upload',        ['pulp-upload', ISV, '{image}']),
+    ('pulp-upload-again',  ['pulp-upload', ISV, '{image}']),
+    ('publish',            ['publish', ISV, APP]),
+    ('status',             ['status', ISV, '--isv_app', APP, '--pulp']),
+]
+
+SERVICES = ['pulp', 's3', 'broker']
+
+
+class Counters(object):
+    """Requests and bytes of a stand-in backend"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add(self, bytes_in, bytes_out):
+        with self._lock:
+            self.requests += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def snapshot(self):
+        with self._lock:
+            return {'requests': self.requests, 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # raas closes streamed responses early (e.g. export GET before range requests)
+        e = sys.exc_info()[1]
+        if isinstance(e, socket.error) and e.errno in (errno.EPIPE, errno.ECONNRESET):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class BackendHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Base of stand-in backends, subclasses implement route(method, path, query, body)"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _handle(self, method):
+        backend = self.server.backend
+        url = urlparse(self.path)
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        try:
+            status, headers, data = backend.route(method, url.path, parse_qs(url.query, True), body, self.headers)
+        except Exception as e:
+            status, headers, data = 500, {}, json.dumps({'error_message': str(e)})
+        if isinstance(data, basestring):
+            size = len(data)
+        else:
+            # (file name, offset, size) served from disk
+            size = data[2]
+        self.send_response(status)
+        headers.setdefault('Content-Type', 'application/json')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        if method != 'HEAD':
+            if isinstance(data, basestring):
+                self.wfile.write(data)
+            else:
+                with open(data[0], 'rb') as f:
+                    f.seek(data[1])
+                    left = size
+                    while left:
+                        chunk = f.read(min(left, 1048576))
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+                        left -= len(chunk)
+        backend.counters.add(len(body), size if method != 'HEAD' else 0)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_HEAD(self):
+        self._handle('HEAD')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class Backend(object):
+    """Stand-in backend served by HTTP server in a background thread"""
+
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.counters = Counters()
+        self._lock = threading.Lock()
+        self._server = HTTPServer(('127.0.0.1', 0), BackendHandler)
+        self._server.backend = self
+        self.url = 'http://127.0.0.1:{0}'.format(self._server.server_address[1])
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def route(self, method, path, query, body, headers):
+        raise NotImplementedError
+
+
+def json_response(data, status=200):
+    return status, {}, json.dumps(data)
+
+
+def file_response(filename, headers):
+    """Serve file, honouring Range request header"""
+    if not os.path.isfile(filename):
+        return 404, {}, ''
+    size = os.path.getsize(filename)
+    match = re.match(r'bytes=(\d+)-(\d*)$', headers.getheader('range') or '')
+    if not match:
+        return 200, {'Content-Type': 'application/octet-stream', 'Accept-Ranges': 'bytes'}, (filename, 0, size)
+    start = int(match.group(1))
+    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    return 206, {'Content-Type': 'application/octet-stream',
+                 'Content-Range': 'bytes {0}-{1}/{2}'.format(start, end, size)}, (filename, start, end - start + 1)
+
+
+class FakePulp(Backend):
+    """Pulp v2 API subset used by raas: uploads, import, tasks, web and export publish"""
+
+    FINISHED_TASK = {'spawned_tasks': [{'task_id': 'bench-task', '_href': '/pulp/api/v2/tasks/bench-task/'}]}
+
+    def __init__(self, work_dir):
+        Backend.__init__(self, work_dir)
+        self.repos = {}
+        self._upload_ids = iter(xrange(1, sys.maxint))
+
+    def _repo_dir(self, repo_id):
+        return os.path.join(self.work_dir, 'docker', repo_id)
+
+    def route(self, method, path, query, body, headers):
+        api = '/pulp/api/v2/'
+        if path == api + 'status/':
+            return json_response({'api_version': '2'})
+        if path.startswith(api + 'tasks/'):
+            return json_response({'state': 'finished'})
+        if path.startswith(api + 'content/orphans/'):
+            return json_response([] if method == 'GET' else None)
+        if path == api + 'content/uploads/' and method == 'POST':
+            with self._lock:
+                upload_id = 'upload-{0}'.format(next(self._upload_ids))
+            open(os.path.join(self.work_dir, upload_id), 'wb').close()
+            return json_response({'upload_id': upload_id})
+        match = re.match(api + r'content/uploads/([^/]+)/(?:(\d+)/)?$', path)
+        if match:
+            filename = os.path.join(self.work_dir, match.group(1))
+            if method == 'PUT':
+                with open(filename, 'r+b') as f:
+                    f.seek(int(match.group(2)))
+                    f.write(body)
+            elif method == 'DELETE' and os.path.isfile(filename):
+                os.remove(filename)
+            return json_response(None)
+        if path == api + 'repositories/' and method == 'POST':
+            payload = json.loads(body)
+            self.repos[payload['id']] = {'notes': payload.get('notes', {}), 'scratchpad': {'tags': []},
+                    'images': set(), 'registry_id': payload['distributors'][0]['distributor_config']['repo-registry-id'],
+                    'redirect_url': None}
+            return json_response({'id': payload['id']}, 201)
+        match = re.match(api + r'repositories/([^/]+)/(.*)$', path)
+        if match:
+            return self._route_repo(method, match.group(1), match.group(2), body)
+        match = re.match(r'/pulp/docker/([^/]+)\.tar$', path)
+        if match:
+            return file_response(self._repo_dir(match.group(1)) + '.tar', headers)
+        match = re.match(r'/pulp/docker/([^/]+)/([^/]+)/(ancestry|json|layer)$', path)
+        if match:
+            return file_response(os.path.join(self._repo_dir(match.group(1)), match.group(2), match.group(3)), headers)
+        return json_response({'error_message': 'Unknown resource {0}'.format(path)}, 404)
+
+    def _route_repo(self, method, repo_id, action, body):
+        repo = self.repos.get(repo_id)
+        if not repo:
+            return json_response({'error_message': 'Missing resource: {0}'.format(repo_id)}, 404)
+        if not action:
+            if method == 'PUT':
+                payload = json.loads(body)
+                repo['notes'].update(payload.get('delta', {}).get('notes', {}))
+                for config in payload.get('distributor_configs', {}).values():
+                    repo['redirect_url'] = config.get('redirect-url', repo['redirect_url'])
+                return json_response({'spawned_tasks': []})
+            return json_response({'id': repo_id, 'notes': repo['notes'], 'scratchpad': repo['scratchpad']})
+        if action == 'search/units/':
+            return json_response([{'metadata': {'image_id': i}} for i in sorted(repo['images'])])
+        if action == 'actions/import_upload/':
+            payload = json.loads(body)
+            self._import(repo_id, repo, os.path.join(self.work_dir, payload['upload_id']),
+                    payload['override_config'].get('mask_id'))
+            return json_response(self.FINISHED_TASK)
+        if action == 'actions/publish/':
+            if json.loads(body)['id'].startswith('docker_export'):
+                self._export(repo_id, repo)
+            return json_response(self.FINISHED_TASK)
+        return json_response({'error_message': 'Unknown action {0}'.format(action)}, 404)
+
+    def _import(self, repo_id, repo, filename, mask_id):
+        """Store images of uploaded tar except mask_id and its parents"""
+        with tarfile.open(filename) as tar:
+            repositories = json.load(tar.extractfile('repositories'))
+            parents = {}
+            for member in tar.getmembers():
+                if member.name.endswith('/json'):
+                    data = json.load(tar.extractfile(member))
+                    parents[data['id']] = data.get('parent')
+            masked = set()
+            image_id = mask_id
+            while image_id:
+                masked.add(image_id)
+                image_id = parents.get(image_id)
+            for image_id in parents:
+                if image_id in masked:
+                    continue
+                image_dir = os.path.join(self._repo_dir(repo_id), image_id)
+                if not os.path.isdir(image_dir):
+                    os.makedirs(image_dir)
+                ancestry, parent = [], image_id
+                while parent:
+                    ancestry.append(parent)
+                    parent = parents.get(parent)
+                with open(os.path.join(image_dir, 'ancestry'), 'w') as f:
+                    json.dump(ancestry, f)
+                with open(os.path.join(image_dir, 'json'), 'w') as f:
+                    f.write(tar.extractfile(image_id + '/json').read())
+                with open(os.path.join(image_dir, 'layer'), 'wb') as f:
+                    shutil.copyfileobj(tar.extractfile(image_id + '/layer.tar'), f)
+                repo['images'].add(image_id)
+        tags = repositories.get(repo['registry_id']) or repositories.values()[0]
+        repo['scratchpad']['tags'] = [{'tag': t, 'image_id': i} for t, i in sorted(tags.items())]
+
+    def _export(self, repo_id, repo):
+        crane = {'type': 'pulp-docker-redirect', 'version': 1, 'repository': repo_id,
+                 'repo-registry-id': repo['registry_id'], 'url': repo['redirect_url'], 'protected': False,
+                 'images': [{'id': i} for i in sorted(repo['images'])],
+                 'tags': dict((t['tag'], t['image_id']) for t in repo['scratchpad']['tags'])}
+        crane_file = self._repo_dir(repo_id) + '.json'
+        with open(crane_file, 'w') as f:
+            json.dump(crane, f)
+        with tarfile.open(self._repo_dir(repo_id) + '.tar', 'w') as tar:
+            tar.add(crane_file, repo_id + '.json')
+            for image_id in sorted(repo['images']):
+                tar.add(os.path.join(self._repo_dir(repo_id), image_id), 'web/' + image_id)
+
+
+class FakeS3(Backend):
+    """S3 path style API subset used by boto: buckets, listing, location, object upload and ACL"""
+
+    XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+    def __init__(self, work_dir):
+        Backend.__init__(self, work_dir)
+        self.buckets = {}
+
+    def _error(self, status, code):
+        return status, {'Content-Type': 'application/xml'}, \
+                '<?xml version="1.0" encoding="UTF-8"?><Error><Code>{0}</Code></Error>'.format(code)
+
+    def route(self, method, path, query, body, headers):
+        bucket_name, _, key = path.lstrip('/').partition('/')
+        if method == 'PUT' and not key:
+            self.buckets.setdefault(bucket_name, {})
+            return 200, {}, ''
+        bucket = self.buckets.get(bucket_name)
+        if bucket is None:
+            return self._error(404, 'NoSuchBucket')
+        if not key:
+            if 'location' in query:
+                return 200, {'Content-Type': 'application/xml'}, \
+                        '<?xml version="1.0" encoding="UTF-8"?><LocationConstraint xmlns="{0}"/>'.format(self.XMLNS)
+            return 200, {'Content-Type': 'application/xml'}, self._list(bucket_name, bucket, query)
+        if method == 'PUT':
+            if 'acl' not in query:
+                digest = hashlib.md5(body).hexdigest()
+                with self._lock:
+                    bucket[key] = (len(body), digest)
+                return 200, {'ETag': '"{0}"'.format(digest)}, ''
+            return 200, {}, ''
+        if key not in bucket:
+            return self._error(404, 'NoSuchKey')
+        return 200, {'ETag': '"{0}"'.format(bucket[key][1])}, ''
+
+    def _list(self, bucket_name, bucket, query):
+        prefix = query.get('prefix', [''])[0]
+        delimiter = query.get('delimiter', [''])[0]
+        max_keys = int(query.get('max-keys', ['1000'])[0])
+        contents, prefixes = [], set()
+        for key in sorted(bucket):
+            if not key.startswith(prefix):
+                continue
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                prefixes.add(prefix + rest.split(delimiter)[0] + delimiter)
+            else:
+                contents.append(key)
+        contents = contents[:max_keys]
+        xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+               '<ListBucketResult xmlns="{0}"><Name>{1}</Name><Prefix>{2}</Prefix>'.format(self.XMLNS, bucket_name, escape(prefix)),
+               '<MaxKeys>{0}</MaxKeys><IsTruncated>false</IsTruncated>'.format(max_keys)]
+        for key in contents:
+            xml.append('<Contents><Key>{0}</Key><Size>{1}</Size><ETag>"{2}"</ETag></Contents>'.format(
+                    escape(key), bucket[key][0], bucket[key][1]))
+        for p in sorted(prefixes)[:max_keys]:
+            xml.append('<CommonPrefixes><Prefix>{0}</Prefix></CommonPrefixes>'.format(escape(p)))
+        xml.append('</ListBucketResult>')
+        return ''.join(xml)
+
+
+class FakeBroker(Backend):
+    """Openshift broker REST API subset and crane ping, crane app is a bare local git repo"""
+
+    def __init__(self, work_dir, domain, app_name):
+        Backend.__init__(self, work_dir)
+        self.domain = domain
+        self.app_name = app_name
+        self.git_dir = os.path.join(work_dir, 'crane.git')
+        init_crane_repo(self.git_dir)
+
+    def route(self, method, path, query, body, headers):
+        if path == '/v1/_ping':
+            return 200, {'Content-Type': 'text/plain'}, 'true'
+        if path == '/broker/rest/domains/{0}'.format(self.domain):
+            return json_response({'status': 'ok', 'messages': [], 'data': {'name': self.domain}})
+        if path == '/broker/rest/domain/{0}/applications'.format(self.domain):
+            app = {'name': self.app_name, 'id': 'bench-app-id', 'git_url': 'file://' + self.git_dir,
+                   'app_url': self.url + '/', 'aliases': []}
+            return json_response({'status': 'ok', 'messages': [], 'data': [app]})
+        return json_response({'status': 'not_found', 'messages': [{'text': 'Not found: ' + path}], 'data': None}, 404)
+
+    def commits(self):
+        out = subprocess.check_output(['git', '--git-dir', self.git_dir, 'rev-list', '--count', 'master'])
+        return int(out.strip())
+
+
+def init_crane_repo(git_dir):
+    """Create bare crane app repo with empty crane/data dir"""
+    work_dir = mkdtemp()
+    try:
+        env = dict(os.environ, GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost',
+                   GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@localhost')
+        os.makedirs(os.path.join(work_dir, 'crane', 'data'))
+        open(os.path.join(work_dir, 'crane', 'data', '.gitkeep'), 'w').close()
+        for cmd in [['git', 'init', '-q'], ['git', 'add', '.'], ['git', 'commit', '-q', '-m', 'Crane app'],
+                    ['git', 'clone', '-q', '--bare', work_dir, git_dir]]:
+            subprocess.check_call(cmd, cwd=work_dir, env=env)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def run_stage(name, argv, conf_dir, env):
+    """Run raas, return wall time in seconds"""
+    cmd = [sys.executable, RAAS, '--nocommit', '--log', 'ERROR'] + argv
+    start = time.time()
+    p = subprocess.Popen(cmd, cwd=conf_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate()[0]
+    wall = time.time() - start
+    if p.returncode:
+        sys.stderr.write(output)
+        raise RuntimeError('raas {0} failed in stage "{1}"'.format(' '.join(argv), name))
+    return wall
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark raas pulp-upload, publish and status against local stand-in backends')
+    parser.add_argument('--layers', type=int, default=5,
+            help='number of ISV layers of generated image, default is 5')
+    parser.add_argument('--layer-size', default='8M', metavar='SIZE[,SIZE...]',
+            help='layer sizes (with K, M or G suffix) from the base, the last one repeats, default is "8M"')
+    parser.add_argument('--redhat-layers', type=int, default=1,
+            help='number of base layers listed in Red Hat metadata, default is 1')
+    parser.add_argument('--image', metavar='IMAGE.tar',
+            help='use existing docker save tar of "{0}" instead of generating one'.format(APP))
+    parser.add_argument('--fetch', default='export', choices=['export', 'web'],
+            help='pulp fetch strategy of publish, default is "export"')
+    parser.add_argument('--download-workers', type=int, default=1,
+            help='parallel range downloads of pulp export, default is 1')
+    parser.add_argument('-j', '--json', action='store_true',
+            help='print results as JSON')
+    parser.add_argument('-k', '--keep', action='store_true',
+            help='keep work dir with backends data and raas config')
+    args = parser.parse_args()
+
+    work_dir = mkdtemp(prefix='raas-bench-')
+    backends = []
+    results = []
+    try:
+        pulp = FakePulp(os.path.join(work_dir, 'pulp'))
+        s3 = FakeS3(os.path.join(work_dir, 's3'))
+        broker = FakeBroker(os.path.join(work_dir, 'broker'), 'bench', 'registry')
+        backends = [pulp, s3, broker]
+        for backend in backends:
+            if not os.path.isdir(backend.work_dir):
+                os.makedirs(backend.work_dir)
+        s3.buckets[BUCKET] = {}
+
+        conf_dir = os.path.join(work_dir, 'conf')
+        os.makedirs(os.path.join(conf_dir, 'redhat', 'metadata'))
+        with open(os.path.join(conf_dir, 'raas.cfg'), 'w') as f:
+            f.write(CONFIG.format(openshift=broker.url, s3=s3.url, pulp=pulp.url, bucket=BUCKET,
+                    fetch=args.fetch, download_workers=args.download_workers))
+        image = args.image
+        redhat_ids = []
+        if not image:
+            image = os.path.join(work_dir, 'image.tar')
+            redhat_ids = [gen_image.image_id('bench', 'redhat', i) for i in range(args.redhat_layers)]
+            images, tagged = gen_image.plan_image(['latest'], args.layers, [gen_image.parse_size(s) for s in args.layer_size.split(',')],
+                    redhat_ids)
+            with open(image, 'wb') as f:
+                gen_image.write_image(f, APP, images, tagged)
+        with open(os.path.join(conf_dir, 'redhat', 'metadata', 'bench-base.json'), 'w') as f:
+            json.dump({'repo-registry-id': 'bench/base', 'images': [{'id': i} for i in redhat_ids]}, f)
+        env = dict(os.environ, RAAS_CACHE_DIR=os.path.join(work_dir, 'cache'))
+
+        for name, argv in STAGES:
+            before = dict((s, b.counters.snapshot()) for s, b in zip(SERVICES, backends))
+            commits = broker.commits()
+            wall = run_stage(name, [a.format(image=image) for a in argv], conf_dir, env)
+            result = {'stage': name, 'wall': wall, 'git_commits': broker.commits() - commits}
+            for service, backend in zip(SERVICES, backends):
+                after = backend.counters.snapshot()
+                result[service] = dict((k, after[k] - before[service][k]) for k in after)
+            results.append(result)
+    finally:
+        for backend in backends:
+            backend.shutdown()
+        if args.keep:
+            print >> sys.stderr, 'Work dir kept in "{0}"'.format(work_dir)
+        else:
+            shutil.rmtree(work_dir)
+
+    if args.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        print '{0:<18} {1:>8}  {2:>20}  {3:>20}  {4:>20}  {5:>4}'.format(
+                'stage', 'wall', 'pulp req/in/out MB', 's3 req/in/out MB', 'broker req/in/out MB', 'git')
+        for r in results:
+            cells = ['{0}/{1:.1f}/{2:.1f}'.format(r[s]['requests'], r[s]['bytes_in'] / 1048576.0,
+                    r[s]['bytes_out'] / 1048576.0) for s in SERVICES]
+            print '{0:<18} {1:>7.3f}s  {2:>20}  {3:>20}  {4:>20}  {5:>4}'.format(
+                    r['stage'], r['wall'], cells[0], cells[1], cells[2], r['git_commits'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# raas - docker registry tooling that integrates with Pulp and Crane
+# Copyright (C) 2015  Red Hat, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Startup benchmark of raas subcommands.
+
+Measures time from starting a fresh raas process to the moment it begins
+running the requested action ("time to first action"). A local
+configuration dir is generated, so no backend is contacted before the
+measured point.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from argparse import ArgumentParser
+from tempfile import mkdtemp
+
+RAAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'raas.py')
+
+CONFIG = """[redhat]
+metadata_repo = file:///nonexistent/crane-metadata.git
+metadata_relpath = files/metadata
+
+[openshift]
+server_url = https://openshift.invalid
+app_git_url = https://github.com/pulp/crane
+app_git_branch = master
+cartridge = python-2.7
+token = token
+
+[aws]
+aws_access_key = key
+aws_secret_access_key = secret
+
+[pulpserver]
+host = pulp.invalid
+username = username
+password = password
+verify_ssl = True
+
+[bench]
+openshift_domain = bench
+openshift_app = registry
+openshift_scale = True
+openshift_gear_size = small
+s3_bucket = bench-bucket
+"""
+
+SUBCOMMANDS = {
+    'status'      : ['status', 'bench'],
+    'status-pulp' : ['status', 'bench', '--pulp'],
+    'setup'       : ['setup', 'bench'],
+    'publish'     : ['publish', 'bench', 'some/app'],
+    'pulp-upload' : ['pulp-upload', 'bench', '/nonexistent/image.tar'],
+    'redhat-sync' : ['redhat-sync'],
+}
+
+MARKER = 'Running "'
+
+
+def time_to_first_action(conf_dir, argv):
+    """Run raas and return seconds until it starts the action"""
+    cmd = [sys.executable, RAAS, '--nocommit', '--log', 'INFO'] + argv
+    start = time.time()
+    p = subprocess.Popen(cmd, cwd=conf_dir, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    try:
+        for line in iter(p.stderr.readline, ''):
+            if MARKER in line:
+                return time.time() - start
+    finally:
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+    raise RuntimeError('raas {0} finished without starting the action'.format(' '.join(argv)))
+
+
+def main():
+    parser = ArgumentParser(description='Measure raas time to first action per subcommand')
+    parser.add_argument('-r', '--runs', type=int, default=5,
+            help='number of runs per subcommand, default is 5')
+    parser.add_argument('-j', '--json', action='store_true',
+            help='print results as JSON')
+    parser.add_argument('subcommands', nargs='*', metavar='SUBCOMMAND',
+            help='subcommands to measure, default is all of: {0}'.format(', '.join(sorted(SUBCOMMANDS))))
+    args = parser.parse_args()
+    for name in args.subcommands:
+        if name not in SUBCOMMANDS:
+            parser.error('unknown subcommand "{0}"'.format(name))
+
+    conf_dir = mkdtemp()
+    results = {}
+    try:
+        with open(os.path.join(conf_dir, 'raas.cfg'), 'w') as f:
+            f.write(CONFIG)
+        for name in args.subcommands or sorted(SUBCOMMANDS):
+            times = sorted(time_to_first_action(conf_dir, SUBCOMMANDS[name]) for _ in range(args.runs))
+            results[name] = {'min'   : times[0],
+                             'median': times[len(times) / 2],
+                             'max'   : times[-1]}
+    finally:
+        shutil.rmtree(conf_dir)
+
+    if args.json:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        print '{0:<14} {1:>8} {2:>8} {3:>8}'.format('subcommand', 'min', 'median', 'max')
+        for name in sorted(results):
+            r = results[name]
+            print '{0:<14} {1:>7.3f}s {2:>7.3f}s {3:>7.3f}s'.format(name, r['min'], r['median'], r['max'])
+
+
+if __name__ == '__main__':
+    main()
@@ -17,33 +17,1041 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import BaseHTTPServer
+import bisect
+import collections
+import errno
+import fcntl
+import functools
+import gc
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
 import logging
 import os
+import Queue
 import re
-import requests
 import shutil
+import socket
+import SocketServer
+import sqlite3
+import subprocess
 import sys
 import tarfile
+import threading
+import weakref
 
+# Backend libraries (boto, git, requests, simplejson) are imported where
+# they are used, so each action pays only for the backends it talks to.
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
-from boto import s3
-from boto.exception import S3CreateError, S3ResponseError
-from boto.s3.connection import S3Connection
 from ConfigParser import SafeConfigParser, NoSectionError, NoOptionError
-from datetime import date
-from git import Repo
-from git.exc import InvalidGitRepositoryError, GitCommandError
+from contextlib import contextmanager
+from cStringIO import StringIO
+from datetime import date, datetime, timedelta
 from glob import glob
-from simplejson.scanner import JSONDecodeError
+from multiprocessing.pool import ThreadPool
 from tempfile import mkdtemp
-from time import sleep
+from time import sleep, time
+from urlparse import urlparse
 
 
 def stdprint(msg, terse_msg=False):
-    if stdprint.terse == terse_msg:
+    # service mode collects messages of each job instead of printing them
+    sink = getattr(stdprint.local, 'sink', None)
+    if sink:
+        sink(msg, terse_msg)
+    elif stdprint.terse == terse_msg:
         print msg
 
+stdprint.terse = False
+stdprint.local = threading.local()
+
+
+log_context = threading.local()
+
+
+def in_current_context(func):
+    """Return wrapper of func running with output and log context of the current thread"""
+    sink = getattr(stdprint.local, 'sink', None)
+    isv = getattr(log_context, 'isv', None)
+    stats = getattr(log_context, 'stats', None)
+
+    def wrapper(*args, **kwargs):
+        stdprint.local.sink = sink
+        log_context.isv = isv
+        log_context.stats = stats
+        return func(*args, **kwargs)
+    return wrapper
+
+
+class RunStats(object):
+    """Timing spans and counters of one run.
+
+    Spans measure backend operations (clone, export, download, extract,
+    upload, push, verify), counters sum HTTP requests and bytes and backend
+    calls are kept as latency histograms per endpoint. At the end of the run
+    they are written as JSON report and Prometheus textfile.
+    """
+
+    _MAX_SPANS = 1000
+    # upper bounds in seconds of latency histogram buckets, the last is +Inf
+    _LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self, action, isv=None, job_id=None):
+        self.action = action
+        self.isv = isv
+        self.job_id = job_id
+        self.started = time()
+        self._lock = threading.Lock()
+        self._spans = []
+        self._totals = {}
+        self._counters = {}
+        self._calls = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.add_span(name, start, time() - start, error)
+
+    def add_span(self, name, start, duration, error=None):
+        with self._lock:
+            total = self._totals.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0, 'errors': 0})
+            total['count'] += 1
+            total['seconds'] += duration
+            total['max'] = max(total['max'], duration)
+            if error:
+                total['errors'] += 1
+            if len(self._spans) < self._MAX_SPANS:
+                self._spans.append({'name': name, 'start': start - self.started, 'duration': duration,
+                        'thread': threading.current_thread().name, 'error': error})
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    @contextmanager
+    def call(self, backend, method, endpoint):
+        """Time backend call made in the block.
+
+        The block sets "status", "sent" and "received" bytes of the yielded dict.
+        """
+        call = {'status': None, 'sent': 0, 'received': 0}
+        start = time()
+        try:
+            yield call
+        except BaseException:
+            call['status'] = 'error'
+            raise
+        finally:
+            self.observe(backend, method, endpoint, time() - start, call['status'], call['sent'], call['received'])
+
+    def _endpoint(self, backend, method, endpoint):
+        key = ' '.join([backend, method, endpoint])
+        if key not in self._calls:
+            self._calls[key] = {'backend': backend, 'method': method, 'endpoint': endpoint, 'count': 0,
+                    'seconds': 0.0, 'max': 0.0, 'buckets': [0] * (len(self._LATENCY_BUCKETS) + 1),
+                    'sent': 0, 'received': 0, 'statuses': {}, 'retries': 0}
+        return self._calls[key]
+
+    def observe(self, backend, method, endpoint, seconds, status=None, sent=0, received=0):
+        with self._lock:
+            call = self._endpoint(backend, method, endpoint)
+            call['count'] += 1
+            call['seconds'] += seconds
+            call['max'] = max(call['max'], seconds)
+            call['buckets'][bisect.bisect_left(self._LATENCY_BUCKETS, seconds)] += 1
+            call['sent'] += sent
+            call['received'] += received
+            status = str(status)
+            call['statuses'][status] = call['statuses'].get(status, 0) + 1
+
+    def retried(self, backend, method, endpoint):
+        with self._lock:
+            self._endpoint(backend, method, endpoint)['retries'] += 1
+
+    def _quantile(self, call, q):
+        """Approximate quantile of call latency by upper bound of its histogram bucket"""
+        rank = q * call['count']
+        seen = 0
+        for bound, n in zip(self._LATENCY_BUCKETS, call['buckets']):
+            seen += n
+            if seen >= rank:
+                return min(bound, call['max'])
+        return call['max']
+
+    def summary(self):
+        """Return table of backend calls per endpoint, slowest total first"""
+        with self._lock:
+            calls = sorted(self._calls.values(), key=lambda c: -c['seconds'])
+            lines = ['{0:<9} {1:<6} {2:<52} {3:>6} {4:>7} {5:>8} {6:>8} {7:>8} {8:>8} {9:>10} {10:>10}'.format(
+                    'backend', 'method', 'endpoint', 'calls', 'retries', 'total', 'p50', 'p95', 'max', 'sent', 'received')]
+            for c in calls:
+                lines.append('{0:<9} {1:<6} {2:<52} {3:>6} {4:>7} {5:>7.3f}s {6:>7.3f}s {7:>7.3f}s {8:>7.3f}s {9:>8.1f}MB {10:>8.1f}MB'.format(
+                        c['backend'], c['method'], c['endpoint'], c['count'], c['retries'], c['seconds'],
+                        self._quantile(c, 0.5), self._quantile(c, 0.95), c['max'],
+                        c['sent'] / 1048576.0, c['received'] / 1048576.0))
+            for name in sorted(self._counters):
+                if name.endswith('.throttled'):
+                    backend = name[:-len('.throttled')]
+                    lines.append('{0} calls throttled {1} times for {2:.3f}s'.format(
+                            backend, self._counters[name], self._counters.get(backend + '.throttle_seconds', 0)))
+        return '\n'.join(lines)
+
+    def report(self, ret=None):
+        with self._lock:
+            return {'action'  : self.action,
+                    'isv'     : self.isv,
+                    'job_id'  : self.job_id,
+                    'started' : self.started,
+                    'duration': time() - self.started,
+                    'result'  : ret,
+                    'totals'  : dict((k, dict(v)) for k, v in self._totals.items()),
+                    'counters': dict(self._counters),
+                    'calls'   : [dict(c, statuses=dict(c['statuses']), buckets=list(c['buckets']),
+                                      bounds=self._LATENCY_BUCKETS + ['+Inf']) for c in self._calls.values()],
+                    'spans'   : list(self._spans)}
+
+    def write_report(self, filename, ret=None):
+        with open(filename, 'w') as f:
+            json.dump(self.report(ret), f, indent=2, sort_keys=True)
+        logging.info('Run report written to "{0}"'.format(filename))
+
+    def write_prometheus(self, filename, ret=None):
+        """Write textfile for node_exporter textfile collector, replacing it atomically.
+
+        The file is overwritten by each run, so all values (also request
+        and byte counts) are gauges of the last run, not monotonic counters.
+        Latency buckets keep "le" labels for histogram_quantile.
+        """
+        report = self.report(ret)
+        labels = 'action="{0}",isv="{1}"'.format(self.action, self.isv or '')
+        lines = ['# TYPE raas_run_duration_seconds gauge',
+                 'raas_run_duration_seconds{{{0}}} {1:.6f}'.format(labels, report['duration']),
+                 '# TYPE raas_run_timestamp_seconds gauge',
+                 'raas_run_timestamp_seconds{{{0}}} {1:.3f}'.format(labels, self.started),
+                 '# TYPE raas_run_result gauge',
+                 'raas_run_result{{{0}}} {1}'.format(labels, ret if ret is not None else 'NaN')]
+        for metric, key in [('raas_span_seconds', 'seconds'), ('raas_span_count', 'count'),
+                ('raas_span_errors', 'errors')]:
+            lines.append('# TYPE {0} gauge'.format(metric))
+            for name in sorted(report['totals']):
+                lines.append('{0}{{{1},span="{2}"}} {3}'.format(metric, labels, name, report['totals'][name][key]))
+        for name in sorted(report['counters']):
+            metric = 'raas_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+            lines.append('# TYPE {0} gauge'.format(metric))
+            lines.append('{0}{{{1}}} {2}'.format(metric, labels, report['counters'][name]))
+        calls = sorted(report['calls'], key=lambda c: (c['backend'], c['endpoint'], c['method']))
+        buckets, sums, counts = [], [], []
+        for c in calls:
+            call_labels = '{0},backend="{1}",method="{2}",endpoint="{3}"'.format(
+                    labels, c['backend'], c['method'], c['endpoint'])
+            cumulative = 0
+            for bound, n in zip(c['bounds'], c['buckets']):
+                cumulative += n
+                buckets.append('raas_backend_call_seconds_bucket{{{0},le="{1}"}} {2}'.format(call_labels, bound, cumulative))
+            sums.append('raas_backend_call_seconds_sum{{{0}}} {1:.6f}'.format(call_labels, c['seconds']))
+            counts.append('raas_backend_call_seconds_count{{{0}}} {1}'.format(call_labels, c['count']))
+        for metric, samples in [('raas_backend_call_seconds_bucket', buckets),
+                ('raas_backend_call_seconds_sum', sums), ('raas_backend_call_seconds_count', counts)]:
+            lines.append('# TYPE {0} gauge'.format(metric))
+            lines.extend(samples)
+        for metric, key in [('raas_backend_call_retries', 'retries'),
+                ('raas_backend_call_sent_bytes', 'sent'), ('raas_backend_call_received_bytes', 'received')]:
+            lines.append('# TYPE {0} gauge'.format(metric))
+            for c in calls:
+                lines.append('{0}{{{1},backend="{2}",method="{3}",endpoint="{4}"}} {5}'.format(
+                        metric, labels, c['backend'], c['method'], c['endpoint'], c[key]))
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_file, filename)
+        logging.info('Prometheus metrics written to "{0}"'.format(filename))
+
+    def save(self, report_filename, metrics_filename=None, ret=None):
+        """Write report and optional metrics textfile, failures are only logged"""
+        try:
+            self.write_report(report_filename, ret)
+            if metrics_filename:
+                self.write_prometheus(metrics_filename, ret)
+        except (IOError, OSError) as e:
+            logging.warn('Failed to write run stats: {0}'.format(e))
+
+
+class ActionProfiler(object):
+    """CPU profile of an action in all its threads, optionally with memory stats.
+
+    There is no allocation tracer in python 2, memory stats are peak RSS and
+    growth of live objects by type between start and end of the action.
+    """
+
+    _TOP = 20
+
+    def __init__(self, memory=False):
+        self._memory = memory
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._rss = None
+        self._types = None
+
+    def _profile_thread(self, frame, event, arg):
+        import cProfile
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def _type_counts(self):
+        gc.collect()
+        return collections.Counter(type(o).__name__ for o in gc.get_objects())
+
+    def run(self, func, *args, **kwargs):
+        """Return result of func called with args, profiling it"""
+        import cProfile
+        import resource
+        if self._memory:
+            self._types = self._type_counts()
+            self._rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        profile = cProfile.Profile()
+        self._profiles.append(profile)
+        # threads started by the action are profiled too
+        threading.setprofile(self._profile_thread)
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            threading.setprofile(None)
+            if self._memory:
+                types = self._type_counts()
+                types.subtract(self._types)
+                self._types = types
+                # ru_maxrss is in kB on Linux
+                self._rss = (self._rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    def stats(self):
+        import pstats
+        with self._lock:
+            stats = pstats.Stats(self._profiles[0], stream=StringIO())
+            for profile in self._profiles[1:]:
+                stats.add(profile)
+        return stats
+
+    def save(self, filename):
+        """Write pstats file and its text summary next to it"""
+        try:
+            self.stats().dump_stats(filename)
+            with open(filename + '.txt', 'w') as f:
+                f.write(self.summary(self._TOP * 5))
+            logging.info('Profile written to "{0}", load it with "python -m pstats {0}"'.format(filename))
+            sys.stderr.write('Profile written to "{0}"\n'.format(filename))
+        except (IOError, OSError) as e:
+            logging.warn('Failed to write profile: {0}'.format(e))
+
+    def summary(self, top=None):
+        """Return top functions by cumulative and own time and memory stats"""
+        top = top or self._TOP
+        stats = self.stats()
+        stats.stream = StringIO()
+        stats.sort_stats('cumulative').print_stats(top)
+        stats.sort_stats('tottime').print_stats(top)
+        lines = [stats.stream.getvalue()]
+        if self._memory:
+            lines.append('Peak RSS: {0:.1f} MB (before action {1:.1f} MB)'.format(
+                    self._rss[1] / 1024.0, self._rss[0] / 1024.0))
+            lines.append('Growth of live objects by type:')
+            for name, n in self._types.most_common(top):
+                if n <= 0:
+                    break
+                lines.append('  {0:>10} {1}'.format('+{0}'.format(n), name))
+        return '\n'.join(lines) + '\n'
+
+
+def run_stats():
+    """Return stats of the run of the current thread"""
+    return getattr(log_context, 'stats', None) or run_stats.unbound
+
+# collects stats of code running outside of any run, never reported
+run_stats.unbound = RunStats(None)
+
+
+def timed(name):
+    """Decorator recording calls of the function as span name in run stats"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with run_stats().span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Governor(object):
+    """Shared rate and concurrency limit of calls to one backend.
+
+    Calls take a token from a bucket refilled at "rate" per second holding at
+    most "burst" tokens and at most "max_in_flight" calls run at once. Waiting
+    calls are let through by priority, control calls (task polling, status,
+    pings) ahead of normal API calls ahead of bulk transfers, then in order of
+    arrival. One governor per backend is shared by all threads, jobs and
+    clients of the process. Time spent waiting is counted in run stats.
+    """
+
+    CONTROL = 0
+    NORMAL  = 1
+    BULK    = 2
+
+    _governors = {}
+    _lock = threading.Lock()
+    _no_slot = staticmethod(lambda: None)
+
+    def __init__(self, backend):
+        self.backend = backend
+        # weak references of held streamed responses, see hold()
+        self._responses = set()
+        # reentrant, GC may release a dropped response (see hold()) in a thread
+        # which holds the lock already
+        self._cond = threading.Condition(threading.RLock())
+        self._waiting = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._limits = None
+        self.configure()
+
+    @classmethod
+    def get(cls, backend):
+        with cls._lock:
+            if backend not in cls._governors:
+                cls._governors[backend] = cls(backend)
+            return cls._governors[backend]
+
+    @classmethod
+    def configure_all(cls, limits):
+        """Set limits of backends from {backend: {rate, burst, max_in_flight}}"""
+        for backend, backend_limits in limits.items():
+            cls.get(backend).configure(**backend_limits)
+
+    def configure(self, rate=None, burst=None, max_in_flight=None):
+        """Set limits, None is unlimited, burst defaults to one second of rate"""
+        limits = (rate, burst, max_in_flight)
+        with self._cond:
+            if limits == self._limits:
+                return
+            if rate or max_in_flight:
+                logging.info('Limiting {0} calls to rate {1}, burst {2}, max in flight {3}'.format(
+                        self.backend, rate or 'unlimited', burst or 'default', max_in_flight or 'unlimited'))
+            self._limits = limits
+            self._rate = rate
+            self._burst = max(1, burst or rate or 1)
+            self._tokens = self._burst
+            self._stamp = time()
+            self._max_in_flight = max_in_flight
+            self._cond.notify_all()
+
+    @property
+    def limited(self):
+        return bool(self._rate or self._max_in_flight)
+
+    @contextmanager
+    def slot(self, priority=NORMAL):
+        """Wait for turn of the call made in the block"""
+        release = self.acquire(priority)
+        try:
+            yield
+        finally:
+            release()
+
+    def acquire(self, priority=NORMAL):
+        """Wait for turn of a call, return function ending it (it can be called more times)"""
+        if not self.limited:
+            return self._no_slot
+        start = time()
+        self._acquire(priority)
+        waited = time() - start
+        if waited >= 0.001:
+            stats = run_stats()
+            stats.count('{0}.throttled'.format(self.backend))
+            stats.count('{0}.throttle_seconds'.format(self.backend), waited)
+            logging.debug('Throttled {0} call for {1:.3f} seconds'.format(self.backend, waited))
+        # set without allocation, so GC cannot release the call again in between
+        released = [False]
+
+        def release():
+            with self._cond:
+                if released[0]:
+                    return
+                released[0] = True
+                self._in_flight -= 1
+                self._cond.notify_all()
+        return release
+
+    def hold(self, response, release):
+        """End call of streamed response when its body is read, it is closed or dropped.
+
+        Works with requests responses (iter_content) and httplib ones (read).
+        Wrappers refer to the response weakly, so it is not kept alive by them.
+        """
+        if release is self._no_slot:
+            return response
+        response_ref = weakref.ref(response, lambda ref: (self._responses.discard(ref), release()))
+        self._responses.add(response_ref)
+        cls = response.__class__
+        if hasattr(response, 'iter_content'):
+            def iter_content_released(*args, **kwargs):
+                try:
+                    for chunk in cls.iter_content(response_ref(), *args, **kwargs):
+                        yield chunk
+                finally:
+                    release()
+            response.iter_content = iter_content_released
+        else:
+            def read_released(*args, **kwargs):
+                r = response_ref()
+                try:
+                    return cls.read(r, *args, **kwargs)
+                finally:
+                    if r.isclosed():
+                        release()
+            response.read = read_released
+
+        def close_released():
+            try:
+                cls.close(response_ref())
+            finally:
+                release()
+        response.close = close_released
+        return response
+
+    def _acquire(self, priority):
+        with self._cond:
+            ticket = (priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    timeout = None
+                    if self._waiting[0] == ticket and \
+                            (not self._max_in_flight or self._in_flight < self._max_in_flight):
+                        if not self._rate:
+                            break
+                        now = time()
+                        self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self._rate)
+                        self._stamp = now
+                        if self._tokens >= 1:
+                            self._tokens -= 1
+                            break
+                        timeout = (1 - self._tokens) / self._rate
+                    self._cond.wait(timeout)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                # next waiter may be let through too
+                self._cond.notify_all()
+            self._in_flight += 1
+
+
+class BackgroundTask(threading.Thread):
+    """Run function in a thread, result() returns its value or raises its error.
+
+    Output and log context of the starting thread are kept in the task.
+    """
+
+    def __init__(self, name, func, *args, **kwargs):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self._args = args
+        self._kwargs = kwargs
+        self._result = None
+        self._exc_info = None
+        self._func = in_current_context(func)
+        self.start()
+
+    def run(self):
+        try:
+            self._result = self._func(*self._args, **self._kwargs)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+
+    def result(self):
+        self.join()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class StreamReader(object):
+    """File-like reader of an iterator of chunks, copying read data to tee file"""
+
+    def __init__(self, chunks, tee=None):
+        self._chunks = chunks
+        self._tee = tee
+        # current chunk and read offset in it, small reads copy only what they return
+        self._chunk = b''
+        self._pos = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._pos >= len(self._chunk):
+                try:
+                    chunk = next(self._chunks)
+                except StopIteration:
+                    break
+                if self._tee:
+                    self._tee.write(chunk)
+                self._chunk, self._pos = chunk, 0
+                continue
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._pos + size)
+            parts.append(self._chunk[self._pos:end])
+            if size > 0:
+                size -= end - self._pos
+            self._pos = end
+        return b''.join(parts)
+
+
+def http_session():
+    """Return HTTP session shared by all backend clients.
+
+    Connections to backends are pooled and reused between calls and threads.
+    """
+    with http_session.lock:
+        if not http_session.session:
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            http_session.session = session
+    return http_session.session
+
+http_session.session = None
+http_session.lock = threading.Lock()
+
+
+def fan_out(func, items, workers=None):
+    """Call func with every item concurrently, return results in order of items.
+
+    Many small blocking backend calls (task polls, pings, HEAD requests) are
+    made from a pool of threads while the calling thread waits for all of
+    them, governors of the backends still limit how many are in flight. An
+    error of a call is raised when all calls are finished.
+    """
+    items = list(items)
+    workers = min(workers or fan_out.workers, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(in_current_context(func), items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+# as many as connections pooled by http_session
+fan_out.workers = 16
+
+
+def endpoint_template(url):
+    """Return path of URL with IDs replaced by "{id}", for per-endpoint stats.
+
+    Numeric and hex segments and names following collection segments (repo,
+    upload, task, domain and app IDs) are replaced, file extensions are kept.
+    Broker URLs must not keep names of ISV domains and apps:
+
+    >>> endpoint_template('https://broker/broker/rest/domains/acme')
+    '/broker/rest/domains/{id}'
+    >>> endpoint_template('https://broker/broker/rest/domain/acme/applications')
+    '/broker/rest/domain/{id}/applications'
+    >>> endpoint_template('https://broker/broker/rest/domains/acme/applications/registry/aliases')
+    '/broker/rest/domains/{id}/applications/{id}/aliases'
+    >>> endpoint_template('https://broker/broker/rest/domain/acme/application/registry')
+    '/broker/rest/domain/{id}/application/{id}'
+    >>> endpoint_template('https://broker/broker/rest/application/5527ab3c500446c9ac000042/deployments')
+    '/broker/rest/application/{id}/deployments'
+    >>> endpoint_template('https://pulp/pulp/docker/acme-acme-app.tar')
+    '/pulp/docker/{id}.tar'
+    """
+    parts = urlparse(url).path.strip('/').split('/')
+    for i, part in enumerate(parts):
+        _, dot, ext = part.partition('.')
+        if endpoint_template.id_re.match(part) or (i and parts[i - 1] in endpoint_template.collections):
+            parts[i] = '{id}' + (dot + ext if ext in endpoint_template.extensions else '')
+    return '/' + '/'.join(parts)
+
+endpoint_template.id_re = re.compile(r'^([0-9]+|[0-9a-f]{12,}|[0-9a-f-]{36})$')
+endpoint_template.collections = ['repositories', 'uploads', 'tasks', 'domains', 'domain', 'applications',
+        'application', 'docker']
+endpoint_template.extensions = ['tar', 'json']
+
+
+def iter_json_array(chunks):
+    """Yield items of JSON array read from iterator of text chunks, one at a time.
+
+    Chunks may be split anywhere, also inside numbers:
+
+    >>> doc = '[1.25, -3e+10, 0.5E-2, 7 , {"a": [1, 2]}, "x,]", null]'
+    >>> all(list(iter_json_array([doc[:i], doc[i:]])) == json.loads(doc) for i in range(len(doc) + 1))
+    True
+    >>> list(iter_json_array(list(doc))) == json.loads(doc)
+    True
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    started = False
+    more = True
+    while True:
+        # skip whitespace and separators before the next item
+        while pos < len(buf) and buf[pos] in ' \t\r\n,[':
+            if buf[pos] == '[':
+                if started:
+                    break
+                started = True
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']' and started:
+            return
+        if pos < len(buf) and not started:
+            raise ValueError('Expected JSON array, found "{0}"'.format(buf[pos:pos + 20]))
+        item = missing = object()
+        if pos < len(buf):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                # item may continue in next chunk (e.g. number "1." + "25"),
+                # accept it only when followed by separator or end of array
+                follow = end
+                while follow < len(buf) and buf[follow] in ' \t\r\n':
+                    follow += 1
+                if follow < len(buf) and buf[follow] not in ',]':
+                    if not more:
+                        raise ValueError('Expected "," or "]" after JSON array item, found "{0}"'.format(
+                                buf[follow:follow + 20]))
+                    item = missing
+                elif follow == len(buf) and more:
+                    item = missing
+            except ValueError:
+                if not more:
+                    raise
+        if item is not missing:
+            yield item
+            pos = end
+            continue
+        if not more:
+            raise ValueError('Unterminated JSON array')
+        try:
+            buf = buf[pos:] + next(chunks)
+            pos = 0
+        except StopIteration:
+            more = False
+
+
+class LogPayload(object):
+    """Log message with JSON payload, serialized only when a handler emits it.
+
+    Payloads longer than log_payload.max_size are truncated, the full payload
+    is kept in local-only payload store (log_payload.store_dir) and the
+    message points to it.
+    """
+
+    def __init__(self, msg, data):
+        self._msg = msg
+        self._data = data
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = self._format()
+        return self._text
+
+    def _format(self):
+        # serialized in pieces, only the logged head of large payloads is kept in memory
+        limit = log_payload.max_size
+        head = []
+        size = 0
+        store = None
+        stored = ''
+        try:
+            for chunk in json.JSONEncoder(indent=2).iterencode(self._data):
+                if limit and size + len(chunk) > limit and store is None and log_payload.store_dir and not stored:
+                    path = os.path.join(log_payload.store_dir, '{0}-{1:05d}.json'.format(
+                            log_payload.run_id, next(log_payload.counter)))
+                    try:
+                        store = open(path, 'w')
+                        store.write(''.join(head))
+                        stored = ', full payload in "{0}"'.format(path)
+                    except IOError as e:
+                        stored = ', failed to store full payload: {0}'.format(e)
+                if store:
+                    store.write(chunk)
+                if not limit or size < limit:
+                    head.append(chunk)
+                size += len(chunk)
+        finally:
+            if store:
+                store.close()
+        text = ''.join(head)
+        if not limit or size <= limit:
+            return '{0}:\n{1}'.format(self._msg, text)
+        return '{0} (truncated to {1} of {2} characters{3}):\n{4}'.format(
+                self._msg, limit, size, stored, text[:limit])
+
+
+def log_payload(msg, data, level=logging.DEBUG):
+    """Log JSON payload (e.g. backend response) with capped size.
+
+    The payload must not be modified after logging, it can be serialized later
+    by background log writer.
+    """
+    if logging.getLogger().isEnabledFor(level):
+        logging.log(level, LogPayload(msg, data))
+
+log_payload.max_size = None
+log_payload.store_dir = None
+log_payload.run_id = '{0}-{1}'.format(int(time()), os.getpid())
+log_payload.counter = itertools.count(1)
+
+
+class QueueLogHandler(logging.Handler):
+    """Hand log records over to a background writer thread.
+
+    Target handlers (see addHandler) format and write the records in the writer
+    thread, so message formatting and payload serialization leave the hot path.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self._handlers = []
+        self._queue = Queue.Queue()
+        self._writer = threading.Thread(target=self._write, name='raas-log-writer')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def addHandler(self, handler):
+        self._handlers = self._handlers + [handler]
+
+    def removeHandler(self, handler):
+        self.flush()
+        self._handlers = [h for h in self._handlers if h is not handler]
+
+    def emit(self, record):
+        # filters run in the writer thread, they get ISV of the logging thread from the record
+        record.isv = getattr(log_context, 'isv', None)
+        if record.exc_info:
+            # traceback must be rendered while it is available
+            self.format(record)
+            record.exc_info = None
+        self._queue.put(record)
+
+    def _write(self):
+        while True:
+            record = self._queue.get()
+            try:
+                if record is None:
+                    return
+                for handler in self._handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        self._queue.join()
+        for handler in self._handlers:
+            handler.flush()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        for handler in self._handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+def prune_dated_dirs(store_dir, keep_days):
+    """Remove subdirs of local store (named by date) older than keep_days"""
+    oldest = (date.today() - timedelta(days=keep_days)).isoformat()
+    for day in os.listdir(store_dir):
+        if day < oldest:
+            logging.info('Removing old "{0}"'.format(os.path.join(store_dir, day)))
+            shutil.rmtree(os.path.join(store_dir, day), ignore_errors=True)
+
+
+def cache_dir(*parts):
+    """Return local cache dir, creating it if needed.
+
+    The cache survives between runs (mount it as a volume when running in a
+    container), its location can be changed with RAAS_CACHE_DIR env var.
+    """
+    base = os.getenv('RAAS_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'raas')
+    path = os.path.join(base, *parts)
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def run_file(store, owner, action, ext, job_id=None):
+    """Return name of new file of this run in local store (reports, profiles) of owner (ISV, "redhat" or "batch")"""
+    prune_dated_dirs(cache_dir(store, owner), run_file.keep_days)
+    name = '{0}-{1}-{2}{3}'.format(datetime.now().strftime('%H%M%S'), action, job_id or os.getpid(), ext)
+    return os.path.join(cache_dir(store, owner, date.today().isoformat()), name)
+
+run_file.keep_days = 30
+
+
+def report_file(owner, action, job_id=None):
+    return run_file('reports', owner, action, '.json', job_id)
+
+
+class CacheLock(object):
+    """Exclusive lock of a cache entry between raas processes.
+
+    The lock is shared (reference counted) within the current process.
+    """
+
+    _held = {}
+
+    def __init__(self, path):
+        self._path = path + '.lock'
+        self._locked = False
+        self.first = False
+
+    def acquire(self, blocking=False):
+        """Get the lock, return True on success"""
+        if self._locked:
+            return True
+        entry = self._held.get(self._path)
+        if entry:
+            entry[1] += 1
+        else:
+            fd = os.open(self._path, os.O_CREAT | os.O_RDWR)
+            try:
+                if blocking:
+                    logging.info('Waiting for cache lock "{0}"'.format(self._path))
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                else:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                os.close(fd)
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                logging.debug('Cache lock "{0}" is held by another process'.format(self._path))
+                return False
+            self._held[self._path] = [fd, 1]
+            self.first = True
+        self._locked = True
+        return True
+
+    def release(self):
+        if not self._locked:
+            return
+        entry = self._held[self._path]
+        entry[1] -= 1
+        if not entry[1]:
+            fcntl.flock(entry[0], fcntl.LOCK_UN)
+            os.close(entry[0])
+            del self._held[self._path]
+        self._locked = False
+
+
+def file_digest(filename, algorithm='sha1'):
+    """Return hex digest of file content"""
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def git_blob_digest(filename):
+    """Return git blob ID of file content"""
+    h = hashlib.sha1('blob {0}\0'.format(os.path.getsize(filename)))
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def git_blob_ids(work_dir, relpath):
+    """Return git blob IDs of files directly in relpath of git worktree,
+    files modified in the worktree (or no git repo at all) are left out"""
+    from git import Repo
+    from git.exc import InvalidGitRepositoryError, NoSuchPathError
+    try:
+        repo = Repo(work_dir)
+    except (InvalidGitRepositoryError, NoSuchPathError):
+        return {}
+    relpath = os.path.normpath(relpath)
+    modified = set(repo.git.diff('--name-only', '--', relpath).splitlines())
+    blobs = {}
+    for line in repo.git.ls_files('-s', '--', relpath).splitlines():
+        info, path = line.split('\t', 1)
+        if os.path.dirname(path) == relpath and path not in modified:
+            blobs[os.path.basename(path)] = info.split()[1]
+    return blobs
+
+
+def fetch_and_rebase(repo, branch):
+    """Fetch origin branch and put local commits (if any) on top of it.
+
+    Return number of local commits not pushed to origin.
+    """
+    from git import Actor
+    from git.exc import GitCommandError
+    repo.git.fetch('origin', '+refs/heads/{0}:refs/remotes/origin/{0}'.format(branch))
+    ahead = int(repo.git.rev_list('--count', 'origin/{0}..HEAD'.format(branch)))
+    if not ahead:
+        repo.git.reset('--hard', 'origin/' + branch)
+        return 0
+    logging.info('Rebasing {0} unpushed commits onto "origin/{1}"'.format(ahead, branch))
+    committer = Actor.committer(repo.config_reader())
+    try:
+        with repo.git.custom_environment(GIT_COMMITTER_NAME=committer.name,
+                GIT_COMMITTER_EMAIL=committer.email):
+            repo.git.rebase('origin/' + branch)
+    except GitCommandError as e:
+        if any(os.path.isdir(os.path.join(repo.git_dir, d)) for d in ('rebase-merge', 'rebase-apply')):
+            repo.git.rebase('--abort')
+        logging.error('Failed to rebase unpushed commits in "{0}", resolve it manually: {1}'.format(
+                repo.working_dir, e))
+        raise ConfigurationError('Failed to rebase unpushed commits')
+    return int(repo.git.rev_list('--count', 'origin/{0}..HEAD'.format(branch)))
+
+
+def sync_git_mirror(url, branch, dest):
+    """Bring a cached clone of url/branch in dest up to date.
+
+    Existing clone only fetches changes since the last run, local commits which
+    were not pushed yet are rebased on top of them. New clone is shallow.
+    """
+    from git import Repo
+    from git.exc import InvalidGitRepositoryError
+    if os.path.isdir(os.path.join(dest, '.git')):
+        try:
+            repo = Repo(dest)
+        except InvalidGitRepositoryError as e:
+            logging.warn('Cached clone "{0}" is broken, clonning again: {1}'.format(dest, e))
+            shutil.rmtree(dest)
+        else:
+            logging.info('Fetching "{0}:{1}" to cached clone "{2}"'.format(url, branch, dest))
+            # drop uncommitted leftovers of interrupted runs, also untracked ones
+            # (new ISV dirs, logs), locks of the cache are kept next to the clone
+            repo.git.reset('--hard')
+            repo.git.clean('-fdx')
+            fetch_and_rebase(repo, branch)
+            return repo
+    logging.info('Clonning "{0}:{1}" to cached clone "{2}"'.format(url, branch, dest))
+    return Repo.clone_from(url, dest, branch=branch, depth=1)
+
 
 class PulpError(Exception):
     pass
@@ -57,14 +1065,36 @@ class PulpServer(object):
     _IMPORTER           = 'docker_importer'
     _EXPORT_DIR         = '/var/www/pub/docker/web/'
     _UNIT_TYPE_ID       = 'docker_image'
+    _DIGEST_NOTE        = '_raas-image-sha256'
+    _FETCH_STRATEGIES   = ['export', 'web']
+    _WEB_FILES          = ['ancestry', 'json', 'layer']
+    _FETCH_WORKERS      = 4
+    _DOWNLOAD_RETRIES   = 5
+    _RANGE_SIZE         = 67108864 # 64 MB per parallel range request
     _CHUNK_SIZE         = 1048576 # 1 MB per upload call
+    # task polling and status go ahead of other calls when pulp calls are limited
+    _CONTROL_ENDPOINTS  = ['/pulp/api/v2/status', '/pulp/api/v2/tasks/{id}']
 
     def __init__(self, server_url, username, password, verify_ssl, isv,
-            isv_app_name):
+            isv_app_name, fetch='export', download_workers=None):
+        if fetch not in self._FETCH_STRATEGIES:
+            logging.error('Invalid pulp fetch strategy "{0}", use one of: {1}'.format(fetch, ', '.join(self._FETCH_STRATEGIES)))
+            raise PulpError('Invalid pulp fetch strategy "{0}"'.format(fetch))
+        self._fetch = fetch
+        if download_workers is None:
+            # many files published by web distributor are fetched in parallel by default
+            download_workers = self._FETCH_WORKERS if fetch == 'web' else 1
+        self._download_workers = max(1, download_workers)
         self._upload_id = None
         self._repo_id = None
         self._data_dir = None
+        self._keep_data_dir = False
+        # set when files of a download are not needed anymore (e.g. S3 upload failed)
+        self._download_cancelled = threading.Event()
         self._exported_local_file = None
+        self._image_digest = None
+        self._repository = None
+        self._only_repository = False
         self.server_url = server_url
         self._username = username
         self._password = password
@@ -78,7 +1108,8 @@ class PulpServer(object):
 
     @server_url.setter
     def server_url(self, val):
-        if val.startswith('https://'):
+        # plain http is used only by local test and benchmark servers
+        if val.startswith('https://') or val.startswith('http://'):
             self._server_url = val
         else:
             self._server_url = 'https://' + val
@@ -90,6 +1121,17 @@ class PulpServer(object):
             logging.info('Created pulp data dir "{0}"'.format(self._data_dir))
         return self._data_dir
 
+    @data_dir.setter
+    def data_dir(self, val):
+        """Use existing data dir, it is kept on cleanup"""
+        self._data_dir = val
+        self._keep_data_dir = True
+        self._exported_local_file = None
+
+    @property
+    def isv_app_name(self):
+        return self._isv_app_name
+
     @property
     def repo_id(self):
         if not self._repo_id:
@@ -120,28 +1162,59 @@ class PulpServer(object):
             logging.info('Received pulp upload ID: {0}'.format(self._upload_id))
         return self._upload_id
 
-    def _call_pulp(self, url, req_type='get', payload=None, return_json=True, p_stream=False):
-        if req_type == 'get':
-            logging.info('Calling pulp URL "{0}"'.format(url))
-            r = requests.get(url, auth=(self._username, self._password), verify=self._verify_ssl, stream=p_stream)
-        elif req_type == 'post':
-            logging.info('Posting to pulp URL "{0}"'.format(url))
-            if payload:
-                logging.debug('Pulp HTTP payload:\n{0}'.format(json.dumps(payload, indent=2)))
-            r = requests.post(url, auth=(self._username, self._password),
-                    data=json.dumps(payload), headers={'content-type': 'application/json'}, verify=self._verify_ssl)
-        elif req_type == 'put':
-            # some calls pass in binary data so we don't log payload data or json encode it here
-            logging.info('Putting to pulp URL "{0}"'.format(url))
-            r = requests.put(url, auth=(self._username, self._password), data=payload, verify=self._verify_ssl)
-        elif req_type == 'delete':
-            logging.info('Delete call to pulp URL "{0}"'.format(url))
-            r = requests.delete(url, auth=(self._username, self._password), verify=self._verify_ssl)
-        else:
+    def _call_pulp(self, url, req_type='get', payload=None, return_json=True, p_stream=False, headers=None):
+        from simplejson.scanner import JSONDecodeError
+        if req_type not in ('get', 'post', 'put', 'delete'):
             logging.error('Invalid value of "req_type" parameter: {0}'.format(req_type))
             raise ValueError('Invalid value of "req_type" parameter')
+        session = http_session()
+        stats = run_stats()
+        endpoint = endpoint_template(url)
+        if endpoint in self._CONTROL_ENDPOINTS:
+            priority = Governor.CONTROL
+        elif p_stream or (req_type == 'put' and endpoint.startswith('/pulp/api/v2/content/uploads/')):
+            priority = Governor.BULK
+        else:
+            priority = Governor.NORMAL
+        governor = Governor.get('pulp')
+        release = governor.acquire(priority)
+        try:
+            with stats.call('pulp', req_type.upper(), endpoint) as call:
+                if req_type == 'get':
+                    logging.info('Calling pulp URL "{0}"'.format(url))
+                    r = session.get(url, auth=(self._username, self._password), verify=self._verify_ssl, stream=p_stream,
+                            headers=headers)
+                elif req_type == 'post':
+                    logging.info('Posting to pulp URL "{0}"'.format(url))
+                    if payload:
+                        log_payload('Pulp HTTP payload', payload)
+                    r = session.post(url, auth=(self._username, self._password),
+                            data=json.dumps(payload), headers={'content-type': 'application/json'}, verify=self._verify_ssl)
+                elif req_type == 'put':
+                    # some calls pass in binary data so we don't log payload data or json encode it here
+                    logging.info('Putting to pulp URL "{0}"'.format(url))
+                    r = session.put(url, auth=(self._username, self._password), data=payload, verify=self._verify_ssl)
+                else:
+                    logging.info('Delete call to pulp URL "{0}"'.format(url))
+                    r = session.delete(url, auth=(self._username, self._password), verify=self._verify_ssl)
+                call['status'] = r.status_code
+                call['sent'] = len(r.request.body or '')
+                # streamed body is read later, its size is taken from headers
+                call['received'] = int(r.headers.get('content-length') or 0) if p_stream else len(r.content)
+        except BaseException:
+            release()
+            raise
+        if p_stream:
+            # transfer of streamed body is limited too
+            governor.hold(r, release)
+        else:
+            release()
 
         logging.debug('Pulp HTTP status code: {0}'.format(r.status_code))
+        stats.count('pulp.requests')
+        stats.count('pulp.bytes_sent', call['sent'])
+        if not p_stream:
+            stats.count('pulp.bytes_received', call['received'])
         if r.status_code >= 500:
             logging.error('Received invalid status code from pulp: {0}'.format(r.status_code))
             raise PulpError('Received invalid status code: {0}'.format(r.status_code))
@@ -155,15 +1228,14 @@ class PulpServer(object):
             # some requests return null
             if not r_json:
                 return r_json
-            logging.debug('Pulp JSON response:\n{0}'.format(json.dumps(r_json, indent=2)))
+            log_payload('Pulp JSON response', r_json)
 
             if 'error_message' in r_json:
                 logging.warn('Error messages from Pulp response: {0}'.format(r_json['error_message']))
                 raise PulpError('Received error messages from pulp: {0}'.format(r_json['error_message']))
 
             if 'spawned_tasks' in r_json:
-                for task in r_json['spawned_tasks']:
-                    self._watch_task(task['task_id'], task['_href'])
+                self.watch_tasks(r_json['spawned_tasks'])
             return r_json
         else:
             return r
@@ -189,6 +1261,11 @@ class PulpServer(object):
         logging.error('Timed out waiting for pulp task "{0}"'.format(tid))
         raise PulpError('Timed out waiting for pulp task "{0}"'.format(tid))
 
+    def watch_tasks(self, tasks, timeout=60, poll=5):
+        """Watch tasks (dicts with "task_id" and "_href") at once, return when all finish"""
+        fan_out(lambda task: self._watch_task(task['task_id'], task['_href'], timeout, poll), tasks)
+
+    @timed('pulp.status')
     def status(self):
         """Check pulp server status"""
         logging.info('Checking pulp status')
@@ -196,13 +1273,15 @@ class PulpServer(object):
         logging.info('Pulp status looks OK')
         stdprint('Pulp status is OK')
 
+    @timed('pulp.verify')
     def verify_repo(self):
-        """Verify pulp repository exists"""
+        """Verify pulp repository exists, return its data"""
         url = '{0}/pulp/api/v2/repositories/{1}/'.format(self.server_url, self.repo_id)
         logging.info('Verifying pulp repository "{0}"'.format(self.repo_id))
-        self._call_pulp(url)
+        r_json = self._call_pulp(url)
         logging.info('Pulp repository "{0}" looks OK'.format(self.repo_id))
         stdprint('Pulp repository is OK')
+        return r_json
 
     def _create_repo(self):
         """Create pulp docker repository"""
@@ -265,23 +1344,65 @@ class PulpServer(object):
         else:
             logging.info('Pulp upload ID is not set')
 
+    @timed('pulp.extract')
     def _extract_image(self, file_upload):
-        if os.path.isfile(os.path.join(self.data_dir, 'repositories')):
+        """Extract image, computing its digest in the same pass"""
+        if self._image_digest and os.path.isfile(os.path.join(self.data_dir, 'repositories')):
             logging.info('Image is already extracted in "{0}"'.format(self.data_dir))
             return
         logging.info('Extracting image "{0}" to "{1}"'.format(file_upload, self.data_dir))
         stdprint('Extracting image "{0}"'.format(file_upload))
-        with tarfile.open(file_upload) as tar:
-            tar.extractall(self.data_dir)
-        logging.info('Image "{0}" extracted to "{1}"'.format(file_upload, self.data_dir))
+        digest = hashlib.sha256()
+        with open(file_upload, 'rb') as f:
+            reader = StreamReader(self._hashed_chunks(f, digest))
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                tar.extractall(self.data_dir)
+            # hash also the padding after end of archive
+            reader.read()
+        self._image_digest = digest.hexdigest()
+        logging.info('Image "{0}" extracted to "{1}", sha256 digest "{2}"'.format(
+                file_upload, self.data_dir, self._image_digest))
+
+    def _hashed_chunks(self, f, digest):
+        for chunk in iter(lambda: f.read(self._CHUNK_SIZE), b''):
+            digest.update(chunk)
+            yield chunk
+
+    def _uploaded_digest(self):
+        """Return digest of image last uploaded to pulp repo, None if unknown"""
+        try:
+            r_json = self.verify_repo()
+        except PulpError:
+            return None
+        return ((r_json or {}).get('notes') or {}).get(self._DIGEST_NOTE)
+
+    def _record_digest(self, digest):
+        """Record digest of uploaded image in pulp repo notes"""
+        url = '{0}/pulp/api/v2/repositories/{1}/'.format(self.server_url, self.repo_id)
+        payload = {
+            'delta': {
+                'notes': {
+                    self._DIGEST_NOTE: digest
+                }
+            }
+        }
+        logging.info('Recording image digest "{0}" in pulp repository "{1}"'.format(digest, self.repo_id))
+        self._call_pulp(url, 'put', json.dumps(payload))
+
+    def _image_repositories(self, file_upload):
+        """Return repositories in image as dict {name: {tag: image ID}}"""
+        self._extract_image(file_upload)
+        with open(os.path.join(self.data_dir, 'repositories')) as f:
+            return json.load(f)
 
     def _get_app_name_from_image(self, file_upload):
         logging.info('Getting app name from the image "{0}"'.format(file_upload))
         stdprint('Getting app name from the image "{0}"'.format(file_upload))
-        self._extract_image(file_upload)
-        with open(os.path.join(self.data_dir, 'repositories')) as f:
-            data = json.load(f)
-        self._isv_app_name = data.keys()[0]
+        repositories = self._image_repositories(file_upload)
+        if len(repositories) > 1:
+            logging.error('Image "{0}" has several repositories: {1}'.format(file_upload, ', '.join(repositories)))
+            raise PulpError('Image has several repositories, upload them with pulp-upload command')
+        self._isv_app_name = self._repository = (repositories.keys() or [None])[0]
         if not self._isv_app_name:
             logging.error('Missing app name in the "repositories" file')
             raise PulpError('Missing app name in the "repositories" file')
@@ -290,98 +1411,229 @@ class PulpServer(object):
         stdprint('Got "{0}" as app name from the image "{1}"'.format(
                 self._isv_app_name, file_upload))
 
+    def _image_ancestry(self, image_id):
+        """Return list of image ID and IDs of its parents, from the top image to the base one"""
+        ancestry = []
+        while image_id:
+            ancestry.append(image_id)
+            filename = os.path.join(self.data_dir, image_id, 'json')
+            try:
+                with open(filename) as f:
+                    data = json.load(f)
+            except (IOError, ValueError) as e:
+                logging.error('Failed to read image metadata file "{0}": {1}'.format(filename, e))
+                raise PulpError('Missing or invalid json metadata file of image "{0}"'.format(image_id))
+            log_payload('Content of file "{0}"'.format(filename), data)
+            image_id = data.get('parent')
+        return ancestry
+
     def _get_hierarchy_from_image(self, file_upload):
+        """Return (hierarchy, image IDs) of uploaded repository in image.
+
+        Hierarchy is the ancestry of image tagged "latest" (or of the first
+        tag), image IDs are all images needed by tags of the repository.
+        """
         logging.info('Getting layers hierarchy from image "{0}"'.format(file_upload))
-        hierarchy = []
-        self._extract_image(file_upload)
-        glob_path = os.path.join(self.data_dir, '*', 'json')
-        logging.info('Checking image metadata files: {0}'.format(glob_path))
-        files = glob(glob_path)
-        logging.debug('Image metadata files: {0}'.format(files))
-        if not files:
-            logging.error('Missing json metadata files in docker image "{0}"'.format(file_upload))
-            raise PulpError('Missing json metadata files in docker image')
-        for fl in files:
-            logging.debug('Inspecting file "{0}"'.format(fl))
-            with open(fl) as f:
-                data = json.load(f)
-            logging.debug('Content of file "{0}":\n{1}'.format(fl,
-                    json.dumps(data, indent=2)))
-            image_id = data['id']
-            logging.debug('Image ID is "{0}"'.format(image_id))
-            if not 'parent' in data:
-                if not image_id in hierarchy:
-                    hierarchy.append(image_id)
-                    logging.debug('Parent ID is missing, adding image ID at the end')
-                else:
-                    logging.debug('Parent ID is missing and image ID is already in the hierarchy')
-                continue
-            parent = data['parent']
-            logging.debug('Parent image ID is "{0}"'.format(parent))
-            if not image_id in hierarchy and not parent in hierarchy:
-                logging.debug('Adding both parent ID and image ID at the beginning of hierarchy')
-                hierarchy.insert(0, parent)
-                hierarchy.insert(0, image_id)
-            elif image_id not in hierarchy:
-                logging.debug('Parent ID is in the hierarchy, adding image ID before parent')
-                hierarchy.insert(hierarchy.index(parent), image_id)
-            elif parent not in hierarchy:
-                logging.debug('Image ID is in the hierarchy, adding parent after image ID')
-                index = hierarchy.index(image_id)
-                if index == len(hierarchy) - 1:
-                    hierarchy.append(parent)
-                else:
-                    hierarchy.insert(index + 1, parent)
-            logging.debug('Current state of hierarchy: {0}'.format(hierarchy))
+        repositories = self._image_repositories(file_upload)
+        tags = repositories.get(self._repository or self._isv_app_name)
+        if tags is None and len(repositories) == 1:
+            tags = repositories.values()[0]
+        if not tags:
+            logging.error('Missing tags of "{0}" in image "{1}"'.format(self._repository or self._isv_app_name, file_upload))
+            raise PulpError('Missing tags of repository in docker image')
+        tag = 'latest' if 'latest' in tags else sorted(tags)[0]
+        hierarchy = self._image_ancestry(tags[tag])
+        image_ids = set(hierarchy)
+        for image_id in tags.values():
+            image_ids.update(self._image_ancestry(image_id))
         logging.info('Got layers hierarchy from image "{0}"'.format(file_upload))
-        logging.debug('Final layers hierarchy in image: {0}'.format(hierarchy))
-        return hierarchy
+        logging.debug('Final layers hierarchy of tag "{0}" in image: {1}'.format(tag, hierarchy))
+        return hierarchy, image_ids
+
+    def _client(self, isv_app_name):
+        """Return new client of the same pulp server for another ISV app"""
+        return PulpServer(self.server_url, self._username, self._password, self._verify_ssl,
+                self._isv, isv_app_name, self._fetch, self._download_workers)
 
-    def upload_image(self, file_upload, redhat_image_ids):
-        """Upload image to pulp repository"""
+    def image_uploads(self, file_upload):
+        """Return list of clients uploading repositories of image tar file.
+
+        The image is extracted once, clients of all its repositories share the
+        extracted data (the first client owns it). With ISV app name set, the
+        image must have one repository and it is uploaded with that name.
+        """
         if not os.path.isfile(file_upload):
             logging.error('Cannot find file to upload to pulp "{0}"'.format(file_upload))
             raise PulpError('Cannot find file "{0}"'.format(file_upload))
-        self.status()
+        owner = self._client(self._isv_app_name)
+        repositories = sorted(owner._image_repositories(file_upload))
+        if not repositories:
+            logging.error('Missing app name in the "repositories" file')
+            raise PulpError('Missing app name in the "repositories" file')
+        if self._isv_app_name and len(repositories) > 1:
+            logging.error('Image "{0}" has several repositories: {1}'.format(file_upload, ', '.join(repositories)))
+            raise PulpError('ISV app name can be used only with image of one repository')
+        logging.info('Image "{0}" has repositories: {1}'.format(file_upload, ', '.join(repositories)))
+        clients = []
+        for name in repositories:
+            if clients:
+                client = self._client(name)
+                client.data_dir = owner.data_dir
+                client._image_digest = owner._image_digest
+            else:
+                client = owner
+                client._isv_app_name = client._isv_app_name or name
+            client._repository = name
+            client._only_repository = len(repositories) > 1
+            clients.append(client)
+        return clients
+
+    @timed('pulp.upload_image')
+    def upload_image(self, file_upload, redhat_image_ids, check_status=True):
+        """Upload image to pulp repository.
+
+        Return False if the same image (by sha256 digest of the tar file) was
+        already uploaded to the repository and nothing was done.
+        """
+        if not os.path.isfile(file_upload):
+            logging.error('Cannot find file to upload to pulp "{0}"'.format(file_upload))
+            raise PulpError('Cannot find file "{0}"'.format(file_upload))
+        if check_status:
+            self.status()
+        self._extract_image(file_upload)
         if not self._isv_app_name:
             self._get_app_name_from_image(file_upload)
+        if self._uploaded_digest() == self._image_digest:
+            logging.info('Image "{0}" is already uploaded to pulp repo "{1}"'.format(file_upload, self.repo_id))
+            stdprint('Image "{0}" is already uploaded to pulp repo "{1}", nothing to do'.format(file_upload, self.repo_id))
+            stdprint(self._isv_app_name, True)
+            return False
+        self._create_repo()
+        hierarchy, image_ids = self._get_hierarchy_from_image(file_upload)
+        repo_image_ids = self._repo_image_ids()
         mask_id = None
-        for i in self._get_hierarchy_from_image(file_upload):
-            if i in redhat_image_ids:
-                mask_id = i
+        for index, image_id in enumerate(hierarchy):
+            if image_id in redhat_image_ids:
+                mask_id = image_id
                 logging.info('Masking Red Hat image ID "{0}" in pulp upload'.format(mask_id))
                 break
+            # top image is always imported to update its tags
+            if index and image_id in repo_image_ids:
+                mask_id = image_id
+                logging.info('Masking image ID "{0}" already in pulp repo in pulp upload'.format(mask_id))
+                break
         else:
-            logging.info('Not masking any Red Hat image ID in pulp upload')
-        self._create_repo()
-        self._upload_bits(file_upload)
+            logging.info('Not masking any image ID in pulp upload')
+        # pulp ignores the masked image and its parents, their layers are not uploaded
+        skip_layers = set(hierarchy[index:]) if mask_id else set()
+        # other repositories of the image are left out of its upload
+        self._upload_bits(file_upload, skip_layers, image_ids if self._only_repository else None)
         self._import_upload(mask_id)
         self._delete_upload_id()
         self._publish_repo()
+        self._record_digest(self._image_digest)
         logging.info('Image "{0}" uploaded to pulp repo "{1}" with name "{2}"'.format(
                 file_upload, self.repo_id, self._isv_app_name))
         stdprint('Image "{0}" uploaded to pulp repo "{1}" with name "{2}"'.format(
                 file_upload, self.repo_id, self._isv_app_name))
         stdprint(self._isv_app_name, True)
+        return True
+
+    def _repo_image_ids(self):
+        """Return set of docker image IDs in pulp repo"""
+        url = '{0}/pulp/api/v2/repositories/{1}/search/units/'.format(self.server_url, self.repo_id)
+        payload = {
+            'criteria': {
+                'type_ids': [self._UNIT_TYPE_ID],
+                'fields': {
+                    'unit': ['image_id']
+                }
+            }
+        }
+        logging.info('Getting image IDs in pulp repository "{0}"'.format(self.repo_id))
+        r_json = self._call_pulp(url, 'post', payload)
+        image_ids = set(unit['metadata']['image_id'] for unit in r_json or [])
+        logging.info('Pulp repository "{0}" has {1} images'.format(self.repo_id, len(image_ids)))
+        return image_ids
+
+    def _slim_image_files(self, skip_layers, image_ids=None):
+        """Yield (path, name in tar) of extracted image, without layer.tar of skip_layers.
+
+        With image_ids set, only those images are included.
+        """
+        for dirpath, dirnames, filenames in os.walk(self.data_dir):
+            dirnames.sort()
+            dirname = os.path.relpath(dirpath, self.data_dir)
+            if dirname != os.curdir:
+                if image_ids is not None and dirname.split(os.sep)[0] not in image_ids:
+                    continue
+                yield dirpath, dirname
+            else:
+                dirname = ''
+            for filename in sorted(filenames):
+                if filename == 'layer.tar' and dirname in skip_layers:
+                    logging.debug('Not uploading layer of image "{0}"'.format(dirname))
+                    continue
+                yield os.path.join(dirpath, filename), os.path.join(dirname, filename)
 
-    def _upload_bits(self, file_upload):
+    def _slim_image_chunks(self, skip_layers, image_ids=None):
+        """Yield chunks of image tar stream built from extracted image, without layers of skip_layers.
+
+        With image_ids set, only those images and the uploaded repository are included.
+        """
+        for path, name in self._slim_image_files(skip_layers, image_ids):
+            info = tarfile.TarInfo(name)
+            st = os.stat(path)
+            info.mtime = int(st.st_mtime)
+            info.mode = st.st_mode & 0o7777
+            data = None
+            if os.path.isdir(path):
+                info.type = tarfile.DIRTYPE
+            elif name == 'repositories' and image_ids is not None:
+                with open(path) as f:
+                    data = json.dumps({self._repository: json.load(f)[self._repository]})
+                info.size = len(data)
+            else:
+                info.size = st.st_size
+            yield info.tobuf(tarfile.GNU_FORMAT)
+            if data is not None:
+                yield data
+            elif info.isfile():
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(self._CHUNK_SIZE), b''):
+                        yield chunk
+            if info.isfile():
+                remainder = info.size % tarfile.BLOCKSIZE
+                if remainder:
+                    yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+        yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+    @timed('pulp.upload')
+    def _upload_bits(self, file_upload, skip_layers=(), image_ids=None):
+        """Upload image tar rebuilt from extracted image, layers of skip_layers are left out.
+
+        With image_ids set, only those images are uploaded.
+        """
         logging.info('Uploading file "{0}" to pulp'.format(file_upload))
+        skipped_size = sum(os.path.getsize(os.path.join(self.data_dir, i, 'layer.tar'))
+                for i in skip_layers if os.path.isfile(os.path.join(self.data_dir, i, 'layer.tar')))
+        if skipped_size:
+            logging.info('Leaving {0:.1f} MB of layers already in pulp out of upload'.format(skipped_size / 1048576.0))
         offset = 0
-        source_file_size = os.path.getsize(file_upload)
-        with open(file_upload, 'r') as f:
-            while True:
-                f.seek(offset)
-                data = f.read(self._CHUNK_SIZE)
-                if not data:
-                    break
-                url = '{0}/pulp/api/v2/content/uploads/{1}/{2}/'.format(self.server_url, self.upload_id, offset)
-                logging.info('Uploading "{0}": {1:.1f} of {2:.1f} MB done'.format(file_upload,  offset / 1048576.0, source_file_size / 1048576.0))
-                stdprint('Uploading file "{0}" to pulp: {1:.1f} of {2:.1f} MB done'.format(file_upload, offset / 1048576.0, source_file_size / 1048576.0))
-                self._call_pulp(url, 'put', data)
-                offset = min(offset + self._CHUNK_SIZE, source_file_size)
-        logging.info('File "{0}" uploaded to pulp'.format(file_upload))
+        reader = StreamReader(self._slim_image_chunks(skip_layers, image_ids))
+        while True:
+            data = reader.read(self._CHUNK_SIZE)
+            if not data:
+                break
+            url = '{0}/pulp/api/v2/content/uploads/{1}/{2}/'.format(self.server_url, self.upload_id, offset)
+            logging.info('Uploading "{0}": {1:.1f} MB done'.format(file_upload, offset / 1048576.0))
+            stdprint('Uploading file "{0}" to pulp: {1:.1f} MB done'.format(file_upload, offset / 1048576.0))
+            self._call_pulp(url, 'put', data)
+            offset += len(data)
+        logging.info('File "{0}" uploaded to pulp, {1:.1f} MB sent'.format(file_upload, offset / 1048576.0))
         stdprint('File "{0}" uploaded to pulp'.format(file_upload))
 
+    @timed('pulp.import')
     def _import_upload(self, mask_id=None):
         """Import uploaded content"""
         logging.info('Importing pulp upload {0} into {1}'.format(self.upload_id, self.repo_id))
@@ -398,6 +1650,7 @@ class PulpServer(object):
         self._call_pulp(url, 'post', payload)
         logging.info('Imported pulp upload {0} into {1}'.format(self.upload_id, self.repo_id))
 
+    @timed('pulp.publish')
     def _publish_repo(self):
         """Publish pulp repository to pulp web server"""
         url = '{0}/pulp/api/v2/repositories/{1}/actions/publish/'.format(self.server_url, self.repo_id)
@@ -409,11 +1662,28 @@ class PulpServer(object):
         self._call_pulp(url, 'post', payload)
         logging.info('Published pulp repository "{0}"'.format(self.repo_id))
 
+    def export_repo(self, redirect_url):
+        """Export pulp repository for crane app with redirect_url, return IDs of export tasks"""
+        self.status()
+        self.verify_repo()
+        if self._fetch == 'web':
+            logging.info('Using files published by pulp web distributor, repository "{0}" is not exported'.format(self.repo_id))
+            return []
+        self._update_redirect_url(redirect_url)
+        task_ids = self._export_repo()
+        # part of previous export must not be resumed
+        for filename in [self.exported_local_file, self.exported_local_file + '.meta']:
+            if os.path.isfile(filename):
+                os.remove(filename)
+        return task_ids
+
+    @timed('pulp.export')
     def _export_repo(self):
         """Export pulp repository to pulp web server as tar file.
 
         The tarball is split into the layer components and crane metadata.
-        It is for the purpose of uploading to remote crane server"""
+        It is for the purpose of uploading to remote crane server.
+        Return IDs of export tasks"""
         url = '{0}/pulp/api/v2/repositories/{1}/actions/publish/'.format(self.server_url, self.repo_id)
         payload = {
             'id': self._EXPORT_DISTRIBUTOR,
@@ -422,75 +1692,466 @@ class PulpServer(object):
             }
         }
         logging.info('Exporting pulp repository "{0}"'.format(self.repo_id))
-        self._call_pulp(url, 'post', payload)
+        r_json = self._call_pulp(url, 'post', payload)
         logging.info('Exported pulp repository "{0}"'.format(self.repo_id))
+        return [task['task_id'] for task in (r_json or {}).get('spawned_tasks', [])]
 
+    @timed('pulp.remove_orphans')
     def remove_orphan_content(self, content_type='docker_image'):
         """Remove orphan content"""
-        if self._list_orphans(content_type):
+        if self._count_orphans(content_type):
             logging.info('Removing orphaned "{0}" content'.format(content_type))
             url = '{0}/pulp/api/v2/content/orphans/{1}/'.format(self.server_url, content_type)
             self._call_pulp(url, 'delete')
             logging.info('Removed orphaned "{0}" content'.format(content_type))
 
-    def _list_orphans(self, content_type='docker_image'):
-        """List (log) orphan content. Defaults to docker content"""
+    def _count_orphans(self, content_type='docker_image'):
+        """Count (log) orphan content. Defaults to docker content"""
         url = '{0}/pulp/api/v2/content/orphans/{1}/'.format(self.server_url, content_type)
         logging.info('Getting orphan "{0}" content'.format(content_type))
-        r_json = self._call_pulp(url)
-        content = [content['image_id'] for content in r_json]
-        logging.info('Orphan "{0}" content: {1}'.format(content_type, content))
-        return content
-
-    def download_repo(self, redirect_url):
-        self.status()
-        self.verify_repo()
-        self._update_redirect_url(redirect_url)
-        self._export_repo()
+        count = sum(1 for _ in self._call_pulp_items(url))
+        logging.info('Found {0} orphan "{1}" content units'.format(count, content_type))
+        return count
+
+    def _call_pulp_items(self, url):
+        """Yield items of JSON list returned by pulp URL, parsed while it is downloaded"""
+        r = self._call_pulp(url, return_json=False, p_stream=True)
+        stats = run_stats()
+        chunks = r.iter_content(self._CHUNK_SIZE)
+        first = ''
+        for first in chunks:
+            stats.count('pulp.bytes_received', len(first))
+            if first.strip():
+                break
+        if first.lstrip().startswith('{'):
+            # error responses are JSON objects
+            rest = ''.join(chunks)
+            try:
+                r_json = json.loads(first + rest)
+            except ValueError as e:
+                logging.error('Failed to parse pulp response: {0}'.format(e))
+                raise PulpError('Failed to parse pulp response: {0}'.format(e))
+            log_payload('Pulp JSON response', r_json)
+            logging.warn('Error messages from Pulp response: {0}'.format(r_json.get('error_message')))
+            raise PulpError('Received error messages from pulp: {0}'.format(r_json.get('error_message')))
+
+        def counted(chunks):
+            for chunk in chunks:
+                stats.count('pulp.bytes_received', len(chunk))
+                yield chunk
+        try:
+            for item in iter_json_array(itertools.chain([first], counted(chunks))):
+                yield item
+        except ValueError as e:
+            logging.error('Failed to parse pulp response: {0}'.format(e))
+            raise PulpError('Failed to parse pulp response: {0}'.format(e))
+
+    @timed('pulp.download')
+    def download_repo(self, redirect_url, on_layer=None, export=True, skip_images=()):
+        """Export repo in pulp, download and extract it.
+
+        The export is extracted while it is being downloaded. on_layer is called
+        with (layer_dir, filenames) as soon as files of a layer are extracted.
+        With export False, the repo exported by a previous run is downloaded.
+        With "web" fetch strategy, files published by web distributor are
+        downloaded instead, except the ones of skip_images.
+        """
+        if export:
+            self.export_repo(redirect_url)
+        elif self._fetch == 'export':
+            self.status()
+            self.verify_repo()
+        if self._fetch == 'web':
+            self._fetch_published(redirect_url, on_layer, skip_images)
+            return
 
         url = '{0}/pulp/docker/{1}.tar'.format(self.server_url, self.repo_id)
         logging.info('Downloading exported repo "{0}"'.format(self.repo_id))
-        stdprint('Downloading exported repo "{0}"'.format(self.repo_id))
-        r = self._call_pulp(url, 'get', return_json=False, p_stream=True)
-        with open(self.exported_local_file, 'wb') as fd:
-            for chunk in r.iter_content(self._CHUNK_SIZE):
-                fd.write(chunk)
+        stdprint('Downloading and extracting exported repo "{0}"'.format(self.repo_id))
+        reader = StreamReader(self._export_chunks(url))
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            self._extract_export(tar, on_layer)
+        # download the whole export, including padding after end of archive
+        reader.read()
         logging.info('Exported repo downloaded to "{0}"'.format(self.exported_local_file))
-        logging.info('Extracting downloaded repo "{0}"'.format(self.exported_local_file))
-        stdprint('Extracting downloaded repo "{0}"'.format(self.exported_local_file))
-        with tarfile.open(self.exported_local_file) as tar:
-            tar.extractall(self.data_dir)
         logging.info('Downloaded repo extracted to "{0}"'.format(self.data_dir))
 
+    def _check_cancelled(self):
+        if self._download_cancelled.is_set():
+            logging.info('Download of pulp repo "{0}" cancelled'.format(self.repo_id))
+            raise PulpError('Download of pulp repo cancelled')
+
+    def _get_range(self, url, start, validator=None, end=None):
+        """Request part of file from start (to end), return response with status 200 or 206"""
+        headers = {}
+        if start or end is not None:
+            headers['Range'] = 'bytes={0}-{1}'.format(start, '' if end is None else end)
+            if validator:
+                headers['If-Range'] = validator
+        r = self._call_pulp(url, 'get', return_json=False, p_stream=True, headers=headers)
+        if r.status_code not in (200, 206):
+            r.close()
+            logging.error('Failed to download "{0}", status code: {1}'.format(url, r.status_code))
+            raise PulpError('Failed to download "{0}"'.format(url))
+        return r
+
+    @staticmethod
+    def _content_range(value):
+        """Return (start, end, total) from Content-Range header, total is None when unknown"""
+        match = re.match(r'^bytes\s+(\d+)-(\d+)/(\d+|\*)$', (value or '').strip())
+        if not match:
+            return None
+        start, end, total = match.groups()
+        return int(start), int(end), None if total == '*' else int(total)
+
+    def _export_chunks(self, url):
+        """Yield chunks of export tar in order, downloading them to exported local file.
+
+        Part of the file kept from an interrupted download is reused and only
+        the rest is downloaded with HTTP Range requests, also when connection
+        breaks during download. With more download workers, large rest is
+        split to ranges downloaded in parallel.
+        """
+        from requests.exceptions import RequestException
+        meta_file = self.exported_local_file + '.meta'
+        meta = {}
+        if os.path.isfile(self.exported_local_file) and os.path.isfile(meta_file):
+            try:
+                with open(meta_file) as f:
+                    meta = json.load(f)
+            except ValueError as e:
+                logging.warn('Ignoring invalid download state "{0}": {1}'.format(meta_file, e))
+        offset = meta.get('offset')
+        if offset is None:
+            offset = os.path.getsize(self.exported_local_file) if meta else 0
+
+        r = self._get_range(url, offset, meta.get('validator'))
+        content_range = self._content_range(r.headers.get('content-range'))
+        if r.status_code == 206 and (not content_range or content_range[0] != offset):
+            logging.warn('Invalid Content-Range of exported repo "{0}", downloading it again'.format(
+                    r.headers.get('content-range')))
+            r.close()
+            offset = 0
+            r = self._get_range(url, offset)
+        if r.status_code == 206:
+            total = content_range[2]
+            logging.info('Resuming download of exported repo at {0:.1f} MB'.format(offset / 1048576.0))
+            stdprint('Resuming download of exported repo at {0:.1f} MB'.format(offset / 1048576.0))
+        else:
+            if offset:
+                logging.info('Exported repo changed or server does not support ranges, downloading it again')
+            offset = 0
+            total = int(r.headers['content-length']) if 'content-length' in r.headers else None
+        meta = {'validator': r.headers.get('etag') or r.headers.get('last-modified'), 'total': total}
+        with open(meta_file, 'w') as f:
+            json.dump(meta, f)
+        with open(self.exported_local_file, 'a+b') as f:
+            f.truncate(offset)
+
+        # part downloaded before
+        with open(self.exported_local_file, 'rb') as f:
+            while f.tell() < offset:
+                chunk = f.read(min(self._CHUNK_SIZE, offset - f.tell()))
+                if not chunk:
+                    break
+                run_stats().count('pulp.bytes_reused', len(chunk))
+                yield chunk
+
+        if total and self._download_workers > 1 and total - offset > self._RANGE_SIZE:
+            r.close()
+            for chunk in self._parallel_export_chunks(url, offset, total, meta, meta_file):
+                yield chunk
+        else:
+            retries = 0
+            with open(self.exported_local_file, 'ab') as f:
+                while True:
+                    try:
+                        for chunk in r.iter_content(self._CHUNK_SIZE):
+                            self._check_cancelled()
+                            f.write(chunk)
+                            offset += len(chunk)
+                            run_stats().count('pulp.bytes_received', len(chunk))
+                            yield chunk
+                        break
+                    except (RequestException, socket.error) as e:
+                        retries += 1
+                        run_stats().retried('pulp', 'GET', endpoint_template(url))
+                        if retries > self._DOWNLOAD_RETRIES:
+                            logging.error('Failed to download exported repo: {0}'.format(e))
+                            raise PulpError('Failed to download exported repo: {0}'.format(e))
+                        logging.warn('Download of exported repo broken at {0:.1f} MB, resuming: {1}'.format(
+                                offset / 1048576.0, e))
+                        f.flush()
+                        r = self._get_range(url, offset, meta['validator'])
+                        content_range = self._content_range(r.headers.get('content-range'))
+                        if r.status_code != 206 or not content_range or content_range[0] != offset:
+                            logging.error('Exported repo changed during download')
+                            raise PulpError('Exported repo changed during download')
+
+        size = os.path.getsize(self.exported_local_file)
+        if total is not None and size != total:
+            logging.error('Downloaded {0} bytes of exported repo, expected {1}'.format(size, total))
+            raise PulpError('Size of downloaded exported repo does not match Content-Length')
+        os.remove(meta_file)
+
+    def _download_range(self, url, filename, byte_range, validator=None):
+        """Download byte range (start, end) of url to the same place in existing
+        filename, resume broken download. Return the range."""
+        from requests.exceptions import RequestException
+        start, end = byte_range
+        pos = start
+        for _ in xrange(self._DOWNLOAD_RETRIES + 1):
+            try:
+                r = self._get_range(url, pos, validator, end)
+                if r.status_code != 206:
+                    r.close()
+                    logging.error('"{0}" changed during download'.format(url))
+                    raise PulpError('"{0}" changed during download'.format(url))
+                with open(filename, 'r+b') as f:
+                    f.seek(pos)
+                    for chunk in r.iter_content(self._CHUNK_SIZE):
+                        self._check_cancelled()
+                        f.write(chunk)
+                        pos += len(chunk)
+                        run_stats().count('pulp.bytes_received', len(chunk))
+                if pos > end:
+                    return byte_range
+            except (RequestException, socket.error) as e:
+                run_stats().retried('pulp', 'GET', endpoint_template(url))
+                logging.warn('Download of "{0}" range {1}-{2} broken, resuming: {3}'.format(url, start, end, e))
+        logging.error('Failed to download range {0}-{1} of "{2}"'.format(start, end, url))
+        raise PulpError('Failed to download "{0}"'.format(url))
+
+    def _parallel_export_chunks(self, url, offset, total, meta, meta_file):
+        """Download rest of export from offset in parallel ranges, yield its chunks in order"""
+        ranges = [(start, min(start + self._RANGE_SIZE, total) - 1)
+                for start in xrange(offset, total, self._RANGE_SIZE)]
+        logging.info('Downloading {0} ranges of exported repo with {1} workers'.format(len(ranges), self._download_workers))
+        # file has holes until all ranges are downloaded, resume only after completed ones
+        meta['offset'] = offset
+        with open(meta_file, 'w') as f:
+            json.dump(meta, f)
+
+        download_range = in_current_context(functools.partial(self._download_range, url,
+                self.exported_local_file, validator=meta['validator']))
+        pool = ThreadPool(self._download_workers)
+        try:
+            for start, end in pool.imap(download_range, ranges):
+                with open(self.exported_local_file, 'rb') as f:
+                    f.seek(start)
+                    while f.tell() <= end:
+                        chunk = f.read(min(self._CHUNK_SIZE, end + 1 - f.tell()))
+                        if not chunk:
+                            break
+                        yield chunk
+                # ranges are complete up to end, resume after it
+                meta['offset'] = end + 1
+                with open(meta_file, 'w') as f:
+                    json.dump(meta, f)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _fetch_published(self, redirect_url, on_layer=None, skip_images=()):
+        """Download image files published by web distributor in parallel, write crane config"""
+        repo = self.verify_repo() or {}
+        image_ids = sorted(self._repo_image_ids())
+        tags = dict((t['tag'], t['image_id']) for t in (repo.get('scratchpad') or {}).get('tags', []))
+        crane_config = {
+            'type': 'pulp-docker-redirect',
+            'version': 1,
+            'repository': self.repo_id,
+            'repo-registry-id': self._isv_app_name,
+            'url': redirect_url,
+            'protected': False,
+            'images': [{'id': image_id} for image_id in image_ids],
+            'tags': tags
+        }
+        with open(self.crane_config_file, 'w') as f:
+            json.dump(crane_config, f)
+        logging.info('Crane config written to "{0}"'.format(self.crane_config_file))
+
+        images = [i for i in image_ids if i not in skip_images]
+        logging.info('Downloading {0} images published in pulp repo "{1}"'.format(len(images), self.repo_id))
+        stdprint('Downloading {0} images published in pulp repo "{1}"'.format(len(images), self.repo_id))
+
+        @in_current_context
+        def fetch_image(image_id):
+            self._check_cancelled()
+            layer_dir = os.path.join(self.data_dir, 'web', image_id)
+            if not os.path.isdir(layer_dir):
+                os.makedirs(layer_dir)
+            for filename in self._WEB_FILES:
+                self._fetch_file('{0}/pulp/docker/{1}/{2}/{3}'.format(self.server_url, self.repo_id, image_id, filename),
+                        os.path.join(layer_dir, filename), split=filename == 'layer')
+            if on_layer:
+                on_layer(layer_dir, list(self._WEB_FILES))
+
+        pool = ThreadPool(self._download_workers)
+        try:
+            pool.map(fetch_image, images)
+        finally:
+            pool.close()
+            pool.join()
+        logging.info('Published images downloaded to "{0}"'.format(self.data_dir))
+
+    def _fetch_file(self, url, filename, split=False):
+        """Download file, with split and more download workers the first range
+        is requested and the rest of large file is downloaded in parallel ranges"""
+        split = split and self._download_workers > 1
+        r = self._get_range(url, 0, end=self._RANGE_SIZE - 1 if split else None)
+        content_range = None
+        if r.status_code == 206:
+            content_range = self._content_range(r.headers.get('content-range'))
+            if not content_range or content_range[0] != 0:
+                r.close()
+                logging.error('Invalid Content-Range of "{0}": {1}'.format(url, r.headers.get('content-range')))
+                raise PulpError('Invalid Content-Range of "{0}"'.format(url))
+        validator = r.headers.get('etag') or r.headers.get('last-modified')
+        with open(filename, 'wb') as f:
+            for chunk in r.iter_content(self._CHUNK_SIZE):
+                self._check_cancelled()
+                f.write(chunk)
+                run_stats().count('pulp.bytes_received', len(chunk))
+            size = f.tell()
+        if content_range:
+            _, end, total = content_range
+            if size != end + 1:
+                logging.error('Downloaded {0} bytes of "{1}", expected {2}'.format(size, url, end + 1))
+                raise PulpError('Incomplete download of "{0}"'.format(url))
+            if total is None:
+                # size unknown, rest of the file in one request
+                r = self._get_range(url, size, validator)
+                if r.status_code != 206:
+                    r.close()
+                    logging.error('"{0}" changed during download'.format(url))
+                    raise PulpError('"{0}" changed during download'.format(url))
+                with open(filename, 'ab') as f:
+                    for chunk in r.iter_content(self._CHUNK_SIZE):
+                        self._check_cancelled()
+                        f.write(chunk)
+                        run_stats().count('pulp.bytes_received', len(chunk))
+            elif total > size:
+                ranges = [(start, min(start + self._RANGE_SIZE, total) - 1)
+                        for start in xrange(size, total, self._RANGE_SIZE)]
+                logging.debug('Downloading {0} more ranges of "{1}"'.format(len(ranges), url))
+                pool = ThreadPool(min(self._download_workers, len(ranges)))
+                try:
+                    pool.map(in_current_context(functools.partial(self._download_range, url, filename,
+                            validator=validator)), ranges)
+                finally:
+                    pool.terminate()
+                    pool.join()
+                if os.path.getsize(filename) != total:
+                    logging.error('Downloaded {0} bytes of "{1}", expected {2}'.format(
+                            os.path.getsize(filename), url, total))
+                    raise PulpError('Incomplete download of "{0}"'.format(url))
+        logging.debug('Downloaded "{0}"'.format(url))
+
+    def _extract_export(self, tar, on_layer=None):
+        """Extract export tar stream, report each layer once its files are extracted"""
+        layer_dir = None
+        filenames = []
+        for member in tar:
+            tar.extract(member, self.data_dir)
+            if not member.isfile():
+                continue
+            name = os.path.normpath(member.name)
+            dirname, filename = os.path.split(name)
+            if dirname != layer_dir:
+                if on_layer and filenames:
+                    on_layer(os.path.join(self.data_dir, layer_dir), filenames)
+                layer_dir = dirname
+                filenames = []
+            if name.split(os.sep)[0] == 'web':
+                filenames.append(filename)
+        if on_layer and filenames:
+            on_layer(os.path.join(self.data_dir, layer_dir), filenames)
+
+    def _layer_files(self, dirpath, filenames, redhat_images):
+        """Return list of (layer_id/file, full_file_path) of layer to be uploaded to aws"""
+        layer_id = os.path.basename(dirpath.rstrip(os.sep))
+        if layer_id in redhat_images:
+            logging.info('Skipping Red Hat layer "{0}"'.format(layer_id))
+            return []
+        files = []
+        for filename in filenames:
+            fname = '/'.join([layer_id, filename])
+            files.append((fname, os.path.join(dirpath, filename)))
+            logging.debug('File "{0}" queued for upload to AWS'.format(fname))
+        return files
+
     def files_for_aws(self, redhat_images):
-        """Return list of tuples of files from pulp to be uploaded to aws.
+        """Yield tuples of files from pulp to be uploaded to aws while walking data dir.
 
-        Format of returned list: [(layer_id/file1, full_file_path1), ...]
+        Format of yielded tuples: (layer_id/file1, full_file_path1)
         """
-        files = []
-        # Walk the directory to get all the files to be uploaded
-        for dirpath, _, filenames in os.walk(os.path.join(self.data_dir, 'web')):
-            for filename in filenames:
-                layer_id = os.path.basename(dirpath.rstrip(os.sep))
-                if layer_id in redhat_images:
-                    logging.info('Skipping Red Hat layer "{0}"'.format(layer_id))
-                    continue
-                fname = '/'.join([layer_id, filename])
-                files.append((fname, os.path.join(dirpath, filename)))
-                logging.debug('File "{0}" queued for upload to AWS'.format(fname))
-        if not files:
+        if not isinstance(redhat_images, (set, frozenset)):
+            redhat_images = set(redhat_images)
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.data_dir, 'web')):
+            # layers of Red Hat images are not walked at all
+            dirnames[:] = [d for d in dirnames if d not in redhat_images]
+            for f in self._layer_files(dirpath, filenames, redhat_images):
+                count += 1
+                yield f
+        if not count:
+            logging.error('No files to upload to AWS')
+            raise PulpError('No files to upload to AWS')
+
+    def download_files_for_aws(self, redirect_url, redhat_images, export=True, progress=None):
+        """Download repo in background, yield files for aws as their layers are extracted.
+
+        Download errors are raised when all extracted files were yielded.
+        Optional progress object is notified of each extracted layer with
+        progress.layer(layer_dir, filenames) and of the completed download
+        with progress.downloaded().
+        """
+        layers = Queue.Queue()
+        self._download_cancelled.clear()
+
+        def on_layer(layer_dir, filenames):
+            if progress:
+                progress.layer(layer_dir, filenames)
+            layers.put((layer_dir, filenames))
+
+        def download():
+            try:
+                self.download_repo(redirect_url, on_layer, export, redhat_images)
+                if progress:
+                    progress.downloaded()
+            finally:
+                layers.put(None)
+
+        task = BackgroundTask('raas-pulp-download', download)
+        count = 0
+        try:
+            for layer_dir, filenames in iter(layers.get, None):
+                for f in self._layer_files(layer_dir, filenames, redhat_images):
+                    count += 1
+                    yield f
+        finally:
+            # stop the download when files are not consumed anymore (it is
+            # finished or the consumer failed), data dir must not be removed
+            # while it is being extracted
+            self._download_cancelled.set()
+            task.join()
+        task.result()
+        if not count:
             logging.error('No files to upload to AWS')
             raise PulpError('No files to upload to AWS')
-        return files
 
     def cleanup(self):
-        if self._data_dir:
+        if self._data_dir and not self._keep_data_dir:
             logging.info('Removing pulp data dir "{0}"'.format(self._data_dir))
             try:
                 shutil.rmtree(self._data_dir)
             except OSError as e:
                 logging.debug('Failed to remove pulp temp dir: {0}'.format(e))
-            self._data_dir = None
+        self._data_dir = None
+        self._keep_data_dir = False
+        self._exported_local_file = None
+        self._image_digest = None
 
 
 class AwsError(Exception):
@@ -500,12 +2161,17 @@ class AwsError(Exception):
 class AwsS3(object):
     """Interact with AWS S3"""
 
-    def __init__(self, bucket_name, app_name, aws_key, aws_secret, create):
+    # S3 connections are reused by all clients of a thread with the same credentials
+    _connections = threading.local()
+
+    def __init__(self, bucket_name, app_name, aws_key, aws_secret, create, endpoint=None, upload_workers=4):
         self._bucket = None
         self._app_name = None
         self._image_ids = set()
         self._bucket_name = bucket_name
         self._create = create
+        self._endpoint = endpoint.rstrip('/') if endpoint else None
+        self._upload_workers = max(1, upload_workers)
         if app_name:
             self._app_name = app_name.replace('/', '-')
         self._connect(aws_key, aws_secret)
@@ -516,6 +2182,7 @@ class AwsS3(object):
 
     @property
     def bucket(self):
+        from boto.exception import S3ResponseError
         if not self._bucket:
             logging.info('Getting S3 bucket "{0}"'.format(self.bucket_name))
             try:
@@ -539,6 +2206,11 @@ class AwsS3(object):
 
     @property
     def app_url(self):
+        from boto.exception import S3ResponseError
+        if self._endpoint:
+            url = '{0}/{1}/{2}/'.format(self._endpoint, self.bucket_name, self._app_name)
+            logging.info('S3 image URL is "{0}"'.format(url))
+            return url
         try:
             loc = self.bucket.get_location()
         except S3ResponseError:
@@ -557,10 +2229,61 @@ class AwsS3(object):
         return url
 
     def _connect(self, aws_key, aws_secret):
-        logging.info('Connecting to AWS')
-        self._conn = S3Connection(aws_access_key_id=aws_key,
-                aws_secret_access_key=aws_secret)
+        self._credentials = (aws_key, aws_secret)
+        self._conn = self._thread_connection()
+
+    def _thread_connection(self):
+        """Return S3 connection of the current thread"""
+        from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+        connections = self._connections.__dict__
+        aws_key, aws_secret = self._credentials
+        key = (aws_key, aws_secret, self._endpoint)
+        if key in connections:
+            return connections[key]
+        if self._endpoint:
+            logging.info('Connecting to S3 endpoint "{0}"'.format(self._endpoint))
+            url = urlparse(self._endpoint)
+            conn = S3Connection(aws_access_key_id=aws_key,
+                    aws_secret_access_key=aws_secret, host=url.hostname, port=url.port,
+                    is_secure=url.scheme == 'https', calling_format=OrdinaryCallingFormat())
+        else:
+            logging.info('Connecting to AWS')
+            conn = S3Connection(aws_access_key_id=aws_key,
+                    aws_secret_access_key=aws_secret)
+        conn.make_request = self._timed_requests(conn.make_request)
+        connections[key] = conn
+        return conn
+
+    @staticmethod
+    def _timed_requests(make_request):
+        """Wrap make_request of S3 connection recording its calls in run stats and limiting them"""
+        def wrapper(method, bucket='', key='', headers=None, data='', query_args=None, *args, **kwargs):
+            endpoint = '/{bucket}' + ('/{key}' if key else '') + ('?' + query_args.split('=')[0] if query_args else '')
+            # object reads and writes are bulk transfers, other calls go ahead of them
+            priority = Governor.BULK if key and method in ('GET', 'PUT') and not query_args else Governor.NORMAL
+            stats = run_stats()
+            governor = Governor.get('s3')
+            release = governor.acquire(priority)
+            try:
+                with stats.call('s3', method, endpoint) as call:
+                    response = make_request(method, bucket, key, headers, data, query_args, *args, **kwargs)
+                    call['status'] = response.status
+                    call['sent'] = int((headers or {}).get('Content-Length') or len(data or ''))
+                    call['received'] = int(response.getheader('content-length') or 0)
+            except BaseException:
+                release()
+                raise
+            if method == 'GET' and priority == Governor.BULK:
+                # object body is read later, its transfer is limited too
+                governor.hold(response, release)
+            else:
+                release()
+            stats.count('s3.requests')
+            stats.count('s3.bytes_sent', call['sent'])
+            return response
+        return wrapper
 
+    @timed('s3.verify')
     def verify_bucket(self):
         logging.info('Looking up S3 bucket "{0}"'.format(self.bucket_name))
         self.bucket
@@ -573,7 +2296,9 @@ class AwsS3(object):
         logging.info('AWS looks OK')
         stdprint('AWS status is OK')
 
+    @timed('s3.create_bucket')
     def create_bucket(self):
+        from boto.exception import S3CreateError, S3ResponseError
         try:
             self.verify_bucket()
             logging.info('S3 bucket "{0}" already exists'.format(self.bucket_name))
@@ -594,20 +2319,88 @@ class AwsS3(object):
                 logging.error('Failed to create "{0}" S3 bucket: {1}'.format(self.bucket_name, e))
                 raise AwsError('Failed to create "{0}" S3 bucket'.format(self.bucket_name))
 
-    def upload_layers(self, files):
-        """Upload image layers to S3 bucket"""
-        logging.info('Uploading files to S3 bucket "{0}"'.format(self.bucket_name))
+    @timed('s3.exists')
+    def existing_files(self, names):
+        """Return set of names of app files found in S3 bucket, checked at once"""
+        from boto.exception import S3ResponseError
+        if not self._app_name:
+            logging.error('ISV app name is required to check S3 files')
+            raise ConfigurationError('Missing ISV app name')
+        self.bucket
+        names = list(names)
+        logging.info('Checking {0} files in S3 bucket "{1}"'.format(len(names), self.bucket_name))
+
+        def exists(name):
+            # boto connections are not shared between threads
+            bucket = self._thread_connection().get_bucket(self.bucket_name, validate=False)
+            try:
+                return bucket.get_key('/'.join([self._app_name, name])) is not None
+            except S3ResponseError as e:
+                logging.error('Failed to check "{0}" in S3 bucket "{1}": {2}'.format(name, self.bucket_name, e))
+                raise AwsError('Failed to check file in S3 bucket "{0}"'.format(self.bucket_name))
+
+        found = set(name for name, present in zip(names, fan_out(exists, names)) if present)
+        logging.info('Found {0} of {1} files in S3 bucket "{2}"'.format(len(found), len(names), self.bucket_name))
+        return found
+
+    @timed('s3.upload')
+    def upload_layers(self, files, on_upload=None):
+        """Upload image layers to S3 bucket.
+
+        files (iterable of (name, path)) are consumed while upload workers
+        upload them. The queue between them is bounded, so slow uploads hold
+        back the producer (e.g. download) instead of piling up files.
+        Optional on_upload is called with name of each uploaded file, one call
+        at a time.
+        """
+        from boto import s3
+        logging.info('Uploading files to S3 bucket "{0}" with {1} workers'.format(
+                self.bucket_name, self._upload_workers))
         if not self._app_name:
             logging.error('ISV app name is required for S3 image upload')
             raise ConfigurationError('Missing ISV app name')
-        for name, path in files:
-            dest = '/'.join([self._app_name, name])
-            key = s3.key.Key(bucket=self.bucket, name=dest)
-            logging.debug('Uploading "{0}"'.format(dest))
-            stdprint('Uploading "{0}" file to "{1}" S3 bucket'.format(dest, self.bucket_name))
-            key.set_contents_from_filename(path)
-            key.set_acl('public-read')
-            logging.debug('Uploaded "{0}"'.format(dest))
+        self.bucket
+        work = Queue.Queue(self._upload_workers * 2)
+        callback_lock = threading.Lock()
+        errors = []
+
+        def upload():
+            # boto connections are not shared between threads
+            bucket = self._thread_connection().get_bucket(self.bucket_name, validate=False)
+            for name, path in iter(work.get, None):
+                if errors:
+                    continue
+                try:
+                    dest = '/'.join([self._app_name, name])
+                    key = s3.key.Key(bucket=bucket, name=dest)
+                    logging.debug('Uploading "{0}"'.format(dest))
+                    stdprint('Uploading "{0}" file to "{1}" S3 bucket'.format(dest, self.bucket_name))
+                    key.set_contents_from_filename(path)
+                    key.set_acl('public-read')
+                    logging.debug('Uploaded "{0}"'.format(dest))
+                    if on_upload:
+                        with callback_lock:
+                            on_upload(name)
+                except Exception as e:
+                    logging.error('Failed to upload "{0}" to S3 bucket "{1}": {2}'.format(name, self.bucket_name, e))
+                    errors.append(sys.exc_info())
+
+        workers = [BackgroundTask('raas-s3-upload-{0}'.format(i), upload) for i in range(self._upload_workers)]
+        try:
+            for item in files:
+                if errors:
+                    break
+                work.put(item)
+        finally:
+            for _ in workers:
+                work.put(None)
+            for worker in workers:
+                worker.join()
+        if errors:
+            # stop producer of the files, e.g. pulp download
+            if hasattr(files, 'close'):
+                files.close()
+            raise errors[0][0], errors[0][1], errors[0][2]
         logging.info('All files uploaded to S3 bucket "{0}"'.format(self.bucket_name))
 
 
@@ -688,7 +2481,7 @@ class Openshift(object):
         if not self._image_ids:
             with open(self.isv_app_crane_file) as f:
                 data = json.load(f)
-            logging.debug('Crane "{0}.json" data:\n{1}'.format(self.isv_app_name, json.dumps(data, indent=2)))
+            log_payload('Crane "{0}.json" data'.format(self.isv_app_name), data)
             self._image_ids = [i['id'] for i in data['images']]
             self._image_ids = set(self._image_ids)
             logging.debug('Crane image IDs: {0}'.format(self._image_ids))
@@ -744,36 +2537,45 @@ class Openshift(object):
         for filename in isv_apps_files:
             with open(filename) as f:
                 data = json.load(f)
-            logging.debug('Content of file "{0}":\n{1}'.format(filename, json.dumps(data, indent=2)))
+            log_payload('Content of file "{0}"'.format(filename), data)
             isv_apps.append(self.docker_pull_url(data['repo-registry-id']))
         logging.info('ISV "{0}" has published apps: {1}'.format(self._isv, isv_apps))
         return isv_apps
 
     def _call_openshift(self, url, req_type='get', payload=None):
+        from simplejson.scanner import JSONDecodeError
+        session = http_session()
         headers = {'authorization': 'Bearer ' + self._token}
         if not url.startswith(self._server_url):
             url = '{0}/{1}'.format(self._server_url, url)
-        if req_type == 'get':
-            logging.info('Calling openshift URL "{0}"'.format(url))
-            headers['Accept'] = 'application/json'
-            r = requests.get(url, headers=headers)
-        elif req_type == 'post':
-            logging.info('Posting to openshift URL "{0}"'.format(url))
-            logging.debug('Posting data: {0}'.format(json.dumps(payload, indent=2)))
-            headers['Accept'] = 'application/json'
-            headers['content-type'] = 'application/json'
-            r = requests.post(url, headers=headers, data=json.dumps(payload))
-        elif req_type == 'put':
-            logging.info('Putting to openshift URL "{0}"'.format(url))
-            logging.debug('Putting data: {0}'.format(json.dumps(payload, indent=2)))
-            headers['Accept'] = 'application/json'
-            headers['content-type'] = 'application/json'
-            r = requests.put(url, headers=headers, data=json.dumps(payload))
-        else:
+        if req_type not in ('get', 'post', 'put'):
             logging.error('Invalid value of "req_type" parameter: {0}'.format(req_type))
             raise ValueError('Invalid value of "req_type" parameter')
+        stats = run_stats()
+        with Governor.get('openshift').slot(), stats.call('openshift', req_type.upper(), endpoint_template(url)) as call:
+            if req_type == 'get':
+                logging.info('Calling openshift URL "{0}"'.format(url))
+                headers['Accept'] = 'application/json'
+                r = session.get(url, headers=headers)
+            elif req_type == 'post':
+                logging.info('Posting to openshift URL "{0}"'.format(url))
+                log_payload('Posting data', payload)
+                headers['Accept'] = 'application/json'
+                headers['content-type'] = 'application/json'
+                r = session.post(url, headers=headers, data=json.dumps(payload))
+            else:
+                logging.info('Putting to openshift URL "{0}"'.format(url))
+                log_payload('Putting data', payload)
+                headers['Accept'] = 'application/json'
+                headers['content-type'] = 'application/json'
+                r = session.put(url, headers=headers, data=json.dumps(payload))
+            call['status'] = r.status_code
+            call['sent'] = len(r.request.body or '')
+            call['received'] = len(r.content)
 
         logging.debug('Openshift HTTP status code: {0}'.format(r.status_code))
+        stats.count('openshift.requests')
+        stats.count('openshift.bytes_received', call['received'])
 
         # Openshift HTTP status codes without json response
         if r.status_code == 401:
@@ -790,7 +2592,7 @@ class Openshift(object):
         except JSONDecodeError as e:
             logging.error('Failed to parse openshift response: {0}'.format(e))
             raise OpenshiftError('Failed to parse openshift response')
-        logging.debug('Openshift JSON response:\n{0}'.format(json.dumps(r_json, indent=2)))
+        log_payload('Openshift JSON response', r_json)
 
         if r_json['messages']:
             msgs = ''
@@ -810,7 +2612,10 @@ class Openshift(object):
             logging.log(log_level, '{0}: {1}'.format(error_msg, '; '.join(oomsgs)))
             raise OpenshiftError(error_msg)
 
+    @timed('openshift.clone')
     def clone_app(self):
+        from git import Repo
+        from git.exc import GitCommandError
         if not self._app_repo:
             logging.info('Clonning openshift application "{0}" to "{1}"'.format(self.app_name, self.app_local_dir))
             try:
@@ -820,6 +2625,7 @@ class Openshift(object):
                 logging.error('Failed to clone openshift application: {0}'.format(e))
                 raise OpenshiftError('Failed to clone openshift application')
 
+    @timed('openshift.verify_domain')
     def verify_domain(self):
         """Verify that Openshift domain exists"""
         url = 'broker/rest/domains/{0}'.format(self.domain)
@@ -829,10 +2635,12 @@ class Openshift(object):
         logging.info('Openshift domain "{0}" looks OK'.format(self.domain))
         stdprint('Openshift domain "{0}" looks OK'.format(self.domain))
 
+    @timed('openshift.verify_app')
     def verify_app(self):
         url = self.get_app_url() + 'v1/_ping'
         logging.info('Verifying openshift crane app status on url "{0}"'.format(url))
-        r = requests.get(url)
+        with Governor.get('crane').slot(Governor.CONTROL):
+            r = http_session().get(url)
         logging.debug('Openshift crane app HTTP status code: {0}'.format(r.status_code))
         if r.status_code != 200:
             logging.warn('Openshift crane app ping HTTP status code is not "200" but: {0}'.format(r.status_code))
@@ -857,6 +2665,7 @@ class Openshift(object):
         logging.info('Openshift status looks OK')
         stdprint('Openshift status is OK')
 
+    @timed('openshift.create_domain')
     def create_domain(self):
         try:
             self.verify_domain()
@@ -874,6 +2683,7 @@ class Openshift(object):
             logging.info('Created openshift domain "{0}"'.format(self.domain))
             stdprint('Created openshift domain "{0}"'.format(self.domain))
 
+    @timed('openshift.create_app')
     def create_app(self, redhat_meta=None):
         """Create an openshift application"""
         try:
@@ -926,6 +2736,7 @@ class Openshift(object):
                          .format(self.get_app_url(), self.app_data['id']))
             stdprint('Created openshift application "{0}"'.format(self.app_name))
 
+    @timed('openshift.update_app')
     def update_app(self, data_files):
         """Copy all config data_files to the crane/data directory"""
         logging.info('Updating openshift crane app "{0}"'.format(self.app_name))
@@ -941,11 +2752,30 @@ class Openshift(object):
             shutil.copy(i, dest_dir)
             files_to_add.append(os.path.join(dest_dir, os.path.basename(i)))
         self._app_repo.index.add(files_to_add)
-        self._app_repo.index.commit('Updated crane configuration')
+        commit = self._app_repo.index.commit('Updated crane configuration')
         self._app_repo.remotes.origin.push()
         self.verify_app()
         logging.info('Openshift crane app "{0}" has been updated'.format(self.app_name))
         stdprint('Updated openshift crane application "{0}"'.format(self.app_name))
+        return commit.hexsha
+
+    def reset(self, isv_app_name=None):
+        """Prepare client for another ISV app, keep the cloned app up to date"""
+        from git.exc import GitCommandError
+        self._isv_app_crane_file = None
+        self._image_ids = set()
+        self._isv_app_name_orig = None
+        self._isv_app_name = None
+        self.isv_app_name = isv_app_name
+        if self._app_repo:
+            logging.info('Updating clone of openshift application "{0}"'.format(self.app_name))
+            try:
+                self._app_repo.git.reset('--hard')
+                fetch_and_rebase(self._app_repo, self._app_git_branch)
+            except (GitCommandError, ConfigurationError) as e:
+                logging.warn('Failed to update clone of openshift application, clonning it again: {0}'.format(e))
+                self._app_repo = None
+                self.cleanup()
 
     def cleanup(self):
         if self._app_local_dir:
@@ -957,6 +2787,235 @@ class Openshift(object):
             self._app_local_dir = None
 
 
+class RedhatImageIndex(object):
+    """Compiled index of Red Hat image IDs from crane metadata files.
+
+    The index is an SQLite file in the local cache, one per metadata dir (it
+    must not get into the config repo). Metadata file is parsed again only
+    when its mtime and size change and its content hash differs from the
+    indexed one.
+    """
+
+    def __init__(self, meta_dir):
+        key = hashlib.sha1(os.path.abspath(meta_dir)).hexdigest()
+        self._index_file = os.path.join(cache_dir('redhat-index'), key + '.sqlite')
+        self._image_ids = None
+
+    @property
+    def image_ids(self):
+        if self._image_ids is None:
+            raise ConfigurationError('Red Hat image ID index is not loaded')
+        return self._image_ids
+
+    def __contains__(self, image_id):
+        return image_id in self.image_ids
+
+    def _connect(self):
+        conn = sqlite3.connect(self._index_file)
+        conn.execute('CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, mtime REAL, size INTEGER, sha1 TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS image_ids (id TEXT, name TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS image_ids_name ON image_ids (name)')
+        return conn
+
+    def refresh(self, filenames):
+        """Bring index up to date with meta files, return names of reindexed files"""
+        try:
+            return self._refresh(filenames)
+        except sqlite3.DatabaseError as e:
+            logging.warn('Rebuilding broken Red Hat image ID index "{0}": {1}'.format(self._index_file, e))
+            os.remove(self._index_file)
+            return self._refresh(filenames)
+
+    def _refresh(self, filenames):
+        conn = self._connect()
+        changed = []
+        try:
+            with conn:
+                known = dict((row[0], row[1:]) for row in conn.execute('SELECT name, mtime, size, sha1 FROM files'))
+                for filename in filenames:
+                    name = os.path.basename(filename)
+                    st = os.stat(filename)
+                    entry = known.pop(name, None)
+                    if entry and entry[0] == st.st_mtime and entry[1] == st.st_size:
+                        continue
+                    digest = file_digest(filename)
+                    if entry and entry[2] == digest:
+                        conn.execute('UPDATE files SET mtime = ?, size = ? WHERE name = ?',
+                                (st.st_mtime, st.st_size, name))
+                        continue
+                    logging.debug('Indexing Red Hat meta file "{0}"'.format(filename))
+                    with open(filename) as f:
+                        data = json.load(f)
+                    conn.execute('DELETE FROM image_ids WHERE name = ?', (name,))
+                    conn.executemany('INSERT INTO image_ids VALUES (?, ?)',
+                            ((i['id'], name) for i in data['images']))
+                    conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                            (name, st.st_mtime, st.st_size, digest))
+                    changed.append(name)
+                for name in known:
+                    logging.debug('Removing Red Hat meta file "{0}" from index'.format(name))
+                    conn.execute('DELETE FROM image_ids WHERE name = ?', (name,))
+                    conn.execute('DELETE FROM files WHERE name = ?', (name,))
+                    changed.append(name)
+            if changed or self._image_ids is None:
+                self._image_ids = frozenset(row[0] for row in conn.execute('SELECT DISTINCT id FROM image_ids'))
+        finally:
+            conn.close()
+        if changed:
+            logging.info('Reindexed Red Hat meta files: {0}'.format(changed))
+        return changed
+
+
+class PublishJournal(object):
+    """Completed stages of ISV app publish, kept in local state dir between runs.
+
+    Stages are "export" (IDs of pulp export tasks), "layers" (downloaded
+    layers with sizes of their files), "download" (export completely
+    downloaded), "uploaded" (files uploaded to S3) and "crane" (commit of
+    updated crane app). Downloaded data are kept in the state dir until
+    the publish completes.
+    """
+
+    _FILE_NAME = 'journal.json'
+    # left by discard while the publish was running, the next one starts over
+    _DISCARDED_FILE_NAME = 'discarded'
+
+    def __init__(self, isv, isv_app_name, restart=False):
+        self.state_dir = self.state_dir_for(isv, isv_app_name)
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        self._file = os.path.join(self.state_dir, self._FILE_NAME)
+        self._lock = threading.Lock()
+        self._cache_lock = CacheLock(self.state_dir)
+        if not self._cache_lock.acquire():
+            logging.error('Publish of "{0}" is already running'.format(isv_app_name))
+            raise ConfigurationError('Publish of "{0}" is already running'.format(isv_app_name))
+        self._stages = {}
+        discarded = os.path.join(self.state_dir, self._DISCARDED_FILE_NAME)
+        if os.path.isfile(discarded):
+            logging.info('Publish journal of "{0}" was discarded during the previous publish'.format(isv_app_name))
+            os.remove(discarded)
+            restart = True
+        if restart:
+            logging.info('Restarting publish of "{0}"'.format(isv_app_name))
+            self.clear()
+        elif os.path.isfile(self._file):
+            try:
+                with open(self._file) as f:
+                    self._stages = json.load(f)
+            except ValueError as e:
+                logging.warn('Ignoring invalid publish journal "{0}": {1}'.format(self._file, e))
+                self.clear()
+            else:
+                logging.info('Resuming publish of "{0}", completed stages: {1}'.format(
+                        isv_app_name, ', '.join(sorted(self._stages)) or 'none'))
+                stdprint('Resuming previous publish of "{0}"'.format(isv_app_name))
+
+    @staticmethod
+    def state_dir_for(isv, isv_app_name):
+        return os.path.join(cache_dir('publish'), isv, isv_app_name.replace('/', '-'))
+
+    @classmethod
+    def discard(cls, isv, isv_app_name):
+        """Remove journal of ISV app, for example when a new image was uploaded.
+
+        Journal of a running publish is only marked as discarded.
+        """
+        state_dir = cls.state_dir_for(isv, isv_app_name)
+        if not os.path.isdir(state_dir):
+            return
+        lock = CacheLock(state_dir)
+        if not lock.acquire():
+            logging.warn('Publish of "{0}" is running, the next publish starts over'.format(isv_app_name))
+            try:
+                open(os.path.join(state_dir, cls._DISCARDED_FILE_NAME), 'w').close()
+            except IOError as e:
+                # the running publish has just completed and removed its journal
+                logging.debug('Failed to mark publish journal as discarded: {0}'.format(e))
+            return
+        try:
+            logging.info('Discarding publish journal of "{0}"'.format(isv_app_name))
+            shutil.rmtree(state_dir, ignore_errors=True)
+        finally:
+            lock.release()
+
+    @property
+    def data_dir(self):
+        path = os.path.join(self.state_dir, 'data')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    def done(self, stage):
+        return stage in self._stages
+
+    def get(self, stage, default=None):
+        return self._stages.get(stage, default)
+
+    def record(self, stage, value=True):
+        with self._lock:
+            self._stages[stage] = value
+            self._save()
+        logging.debug('Publish stage "{0}" recorded in journal'.format(stage))
+
+    def forget(self, *stages):
+        with self._lock:
+            for stage in stages:
+                self._stages.pop(stage, None)
+            self._save()
+
+    def _update(self, stage, key, value):
+        with self._lock:
+            self._stages.setdefault(stage, {})[key] = value
+            self._save()
+
+    def _save(self):
+        temp_file = self._file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self._stages, f)
+        os.rename(temp_file, self._file)
+
+    def layer(self, layer_dir, filenames):
+        """Record downloaded layer"""
+        sizes = dict((f, os.path.getsize(os.path.join(layer_dir, f))) for f in filenames)
+        self._update('layers', os.path.relpath(layer_dir, self.data_dir), sizes)
+
+    def downloaded(self):
+        self.record('download')
+
+    def uploaded(self, name):
+        """Record file uploaded to S3"""
+        self._update('uploaded', name, True)
+
+    def verify_layers(self):
+        """Return True if all downloaded layers are still in data dir"""
+        for layer_dir, sizes in self.get('layers', {}).items():
+            for filename, size in sizes.items():
+                path = os.path.join(self.data_dir, layer_dir, filename)
+                if not os.path.isfile(path) or os.path.getsize(path) != size:
+                    logging.warn('Downloaded file "{0}" is missing or changed'.format(path))
+                    return False
+        return True
+
+    def clear(self):
+        """Forget all stages and downloaded data"""
+        with self._lock:
+            self._stages = {}
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+            if os.path.isfile(self._file):
+                os.remove(self._file)
+
+    def complete(self):
+        """Publish completed, remove the journal"""
+        logging.info('Removing publish journal "{0}"'.format(self._file))
+        self.clear()
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+        self.close()
+
+    def close(self):
+        self._cache_lock.release()
+
+
 class ConfigurationError(Exception):
     pass
 
@@ -966,17 +3025,33 @@ class Configuration(object):
 
     _CONFIG_FILE_NAME    = 'raas.cfg'
     _CONFIG_REPO_ENV_VAR = 'RAAS_CONF_REPO'
+    _MAIN_SECTIONS       = ['redhat', 'openshift', 'aws', 'pulpserver', 'limits']
+    _LIMITED_BACKENDS    = ['pulp', 'openshift', 's3', 'crane']
+
+    _PUSH_RETRIES        = 5
+    # Red Hat image ID indexes by metadata dir, kept warm in service mode
+    _redhat_indexes      = {}
+    _PAYLOAD_KEEP_DAYS   = 14
 
     def __init__(self, isv, config_branch, action, create=False,
             isv_app_name=None, file_upload=None, oodomain=None, ooapp=None,
-            ooscale=True, oogearsize=None, s3bucket=None):
+            ooscale=True, oogearsize=None, s3bucket=None, push='now'):
         """Setup Configuration object.
 
         Use current working dir as local config if it exists,
         otherwise clone repo based on RAAS_CONF_REPO env var.
         """
+        from git import Repo
+        from git.exc import InvalidGitRepositoryError
         self._pulp_repo = None
-        self._redhat_image_ids = set()
+        self._cache_lock = None
+        self._temp_clone = False
+        self._repo_url = None
+        self._push = push
+        self._redhat_image_index = None
+        self._changed_files = []
+        self._removed_files = []
+        self._log_file_handler = None
         self._oodomain_param = False
         self._ooapp_param = False
         self._oogearsize_param = False
@@ -999,6 +3074,7 @@ class Configuration(object):
             logging.info('Using configuration in current dir "{0}"'.format(self._conf_dir))
             try:
                 self._config_repo = Repo(self._conf_dir)
+                self._push_branch = self._config_repo.active_branch.name
                 logging.info('Found git repository in current dir "{0}"'.format(self._conf_dir))
             except InvalidGitRepositoryError:
                 self._config_repo = None
@@ -1012,13 +3088,12 @@ class Configuration(object):
                         .format(self._CONFIG_FILE_NAME, self._CONFIG_REPO_ENV_VAR))
                 raise ConfigurationError('Configuration file in current dir or ' + \
                         '"{0}" env var is required'.format(self._CONFIG_REPO_ENV_VAR))
-            self._conf_dir = mkdtemp()
-            logging.info('Clonning config repo from "{0}:{1}" to "{2}"'.format(
-                    repo_url, self._config_branch, self._conf_dir))
-            self._config_repo = Repo.clone_from(repo_url, self._conf_dir,
-                    branch=self._config_branch)
+            self._clone_config_repo(repo_url)
 
         self._conf_file = os.path.join(self._conf_dir, self._CONFIG_FILE_NAME)
+        self._load_config_file()
+
+    def _load_config_file(self):
         if not os.path.isfile(self._conf_file):
             logging.error('Config file "{0}" not found'.format(self._conf_file))
             raise ConfigurationError('Missing config file')
@@ -1027,12 +3102,46 @@ class Configuration(object):
         logging.info('Loaded config file "{0}"'.format(self._conf_file))
 
         self._setup_isv_config_dirs()
-        if self._action != 'pulp-upload':
+        if self._action != 'flush':
+            self._compress_old_logs()
+        if self._action not in ['pulp-upload', 'redhat-sync', 'flush']:
             self._setup_isv_config_file()
             self._validate_config_file()
         else:
             self._validate_config_file(True)
 
+    def reuse(self, action, isv_app_name=None, file_upload=None):
+        """Prepare configuration kept by service mode for next job of the ISV.
+
+        Changes pushed by other runs are fetched into the cached clone (its
+        outbox is kept) and the config file is loaded again, Red Hat image ID
+        index stays warm. Return False if the cached clone is used by another
+        raas process now, a new Configuration (temporary clone) is needed then.
+        """
+        from git.exc import GitCommandError
+        if self._temp_clone:
+            return False
+        if self._repo_url:
+            self._cache_lock = CacheLock(self._conf_dir)
+            if not self._cache_lock.acquire():
+                self._cache_lock = None
+                return False
+            if self._cache_lock.first:
+                try:
+                    self._config_repo = sync_git_mirror(self._repo_url, self.config_branch, self._conf_dir)
+                except GitCommandError as e:
+                    logging.error('Failed to update cached config repo: {0}'.format(e))
+                    raise ConfigurationError('Failed to update cached config repo')
+        self._action = action
+        self.isv_app_name = isv_app_name
+        self.file_upload = file_upload
+        self._changed_files = []
+        self._removed_files = []
+        # meta files may have changed, warm index only reindexes those
+        self._redhat_image_index = None
+        self._load_config_file()
+        return True
+
     @property
     def config_branch(self):
         return self._config_branch
@@ -1051,6 +3160,11 @@ class Configuration(object):
 
     @isv.setter
     def isv(self, val):
+        if val is None:
+            # actions not related to any ISV, e.g. redhat-sync
+            self._isv = None
+            logging.debug('ISV is not set')
+            return
         if not val.isalnum():
             logging.error('ISV "{0}" must contain only alphanumeric characters'.format(val))
             raise ValueError('Invalid ISV name "{0}"'.format(val))
@@ -1183,6 +3297,28 @@ class Configuration(object):
         logging.debug('Using "{0}" as log file'.format(l_file))
         return l_file
 
+    def open_log(self, log_handler, formatter, isv_only=False):
+        """Write records of log_handler to log file in config repo until commit.
+
+        With isv_only, only records logged in context of this ISV are written.
+        """
+        self.close_log()
+        handler = logging.FileHandler(self.logfile)
+        handler.setFormatter(formatter)
+        handler.setLevel(logging.DEBUG)
+        if isv_only:
+            handler.addFilter(IsvLogFilter(self.isv))
+        log_handler.addHandler(handler)
+        self._log_file_handler = (log_handler, handler)
+
+    def close_log(self):
+        """Stop writing log file, worktree must be clean for rebase and push of commits"""
+        if self._log_file_handler:
+            log_handler, handler = self._log_file_handler
+            self._log_file_handler = None
+            log_handler.removeHandler(handler)
+            handler.close()
+
     @property
     def metafile(self):
         if not self.isv_app_name:
@@ -1200,15 +3336,26 @@ class Configuration(object):
             raise ConfigurationError('File "{0}" does not exist'.format(val))
         logging.debug('Copying file "{0}" to config meta dir'.format(val))
         shutil.copy(val, self._metadir)
+        self._changed_files.append(os.path.join(self._metadir, os.path.basename(val)))
 
     @property
     def pulp_conf(self):
+        if self._parsed_config.has_option('pulpserver', 'fetch'):
+            fetch = self._parsed_config.get('pulpserver', 'fetch')
+        else:
+            fetch = 'export'
+        if self._parsed_config.has_option('pulpserver', 'download_workers'):
+            download_workers = self._parsed_config.getint('pulpserver', 'download_workers')
+        else:
+            download_workers = None
         return {'server_url'  : self._parsed_config.get('pulpserver', 'host'),
                 'username'    : self._parsed_config.get('pulpserver', 'username'),
                 'password'    : self._parsed_config.get('pulpserver', 'password'),
                 'verify_ssl'  : self._parsed_config.getboolean('pulpserver', 'verify_ssl'),
                 'isv'         : self.isv,
-                'isv_app_name': self.isv_app_name}
+                'isv_app_name': self.isv_app_name,
+                'fetch'       : fetch,
+                'download_workers': download_workers}
 
     @property
     def openshift_conf(self):
@@ -1227,16 +3374,52 @@ class Configuration(object):
 
     @property
     def aws_conf(self):
+        if self._parsed_config.has_option('aws', 'endpoint'):
+            endpoint = self._parsed_config.get('aws', 'endpoint')
+        else:
+            endpoint = None
+        if self._parsed_config.has_option('aws', 'upload_workers'):
+            upload_workers = self._parsed_config.getint('aws', 'upload_workers')
+        else:
+            upload_workers = 4
         return {'bucket_name': self._parsed_config.get(self.isv, 's3_bucket'),
                 'app_name'   : self._isv_app_name,
                 'aws_key'    : self._parsed_config.get('aws', 'aws_access_key'),
                 'aws_secret' : self._parsed_config.get('aws', 'aws_secret_access_key'),
-                'create'     : self._create}
+                'create'     : self._create,
+                'endpoint'   : endpoint,
+                'upload_workers': upload_workers}
+
+    @property
+    def limits_conf(self):
+        """Rate and concurrency limits of backends from optional "limits" section"""
+        limits = {}
+        for backend in self._LIMITED_BACKENDS:
+            limits[backend] = {}
+            for option, parse in [('rate', float), ('burst', int), ('max_in_flight', int)]:
+                name = '{0}_{1}'.format(backend, option)
+                value = None
+                if self._parsed_config.has_option('limits', name):
+                    try:
+                        value = parse(self._parsed_config.get('limits', name))
+                    except ValueError as e:
+                        logging.error('"{0}" option in "limits" section is not a number: {1}'.format(name, e))
+                        raise ConfigurationError('"{0}" option in "limits" section is not a number'.format(name))
+                    if value <= 0:
+                        logging.error('"{0}" option in "limits" section must be positive'.format(name))
+                        raise ConfigurationError('"{0}" option in "limits" section must be positive'.format(name))
+                limits[backend][option] = value
+        return limits
 
     @property
     def redhat_meta_conf(self):
+        if self._parsed_config.has_option('redhat', 'metadata_branch'):
+            branch = self._parsed_config.get('redhat', 'metadata_branch')
+        else:
+            branch = 'master'
         return {'git_repo_url': self._parsed_config.get('redhat', 'metadata_repo'),
-                'relpath'     : self._parsed_config.get('redhat', 'metadata_relpath')}
+                'relpath'     : self._parsed_config.get('redhat', 'metadata_relpath'),
+                'branch'      : branch}
 
     @property
     def redhat_meta_files(self):
@@ -1251,32 +3434,232 @@ class Configuration(object):
 
     @property
     def redhat_image_ids(self):
-        if not self._redhat_image_ids:
-            for filename in self.redhat_meta_files:
-                logging.debug('Reading Red Hat meta file "{0}"'.format(filename))
-                with open(filename) as f:
-                    data = json.load(f)
-                logging.debug('Red Hat meta file "{0}" data:\n{1}'.format(
-                        filename, json.dumps(data, indent=2)))
-                for i in data['images']:
-                    self._redhat_image_ids.add(i['id'])
-            logging.debug('Red Hat image IDs: {0}'.format(self._redhat_image_ids))
-        return self._redhat_image_ids
+        if not self._redhat_image_index:
+            meta_dir = os.path.join(self._conf_dir, 'redhat', 'metadata')
+            if meta_dir not in self._redhat_indexes:
+                self._redhat_indexes[meta_dir] = RedhatImageIndex(meta_dir)
+            self._redhat_image_index = self._redhat_indexes[meta_dir]
+            self._redhat_image_index.refresh(self.redhat_meta_files)
+            logging.debug('Loaded {0} Red Hat image IDs'.format(len(self._redhat_image_index.image_ids)))
+        return self._redhat_image_index.image_ids
+
+    @timed('redhat.sync')
+    def sync_redhat_meta(self):
+        """Copy changed Red Hat crane metadata files from cached mirror of metadata repo"""
+        from git.exc import GitCommandError
+        try:
+            conf = self.redhat_meta_conf
+        except (NoSectionError, NoOptionError) as e:
+            logging.error('Red Hat metadata repo is not configured: {0}'.format(e))
+            raise ConfigurationError('Red Hat metadata repo is not configured')
+        key = hashlib.sha1('{0}#{1}'.format(conf['git_repo_url'], conf['branch'])).hexdigest()
+        mirror_dir = os.path.join(cache_dir('redhat-metadata'), key)
+        lock = CacheLock(mirror_dir)
+        if not lock.acquire():
+            logging.error('Red Hat metadata mirror "{0}" is used by another raas process'.format(mirror_dir))
+            raise ConfigurationError('Red Hat metadata mirror is locked')
+        try:
+            stdprint('Syncing Red Hat metadata from "{0}"'.format(conf['git_repo_url']))
+            try:
+                sync_git_mirror(conf['git_repo_url'], conf['branch'], mirror_dir)
+            except GitCommandError as e:
+                logging.error('Failed to sync Red Hat metadata repo: {0}'.format(e))
+                raise ConfigurationError('Failed to sync Red Hat metadata repo')
+            glob_path = os.path.join(mirror_dir, conf['relpath'], '*.json')
+            logging.info('Looking for Red Hat meta files in "{0}"'.format(glob_path))
+            src_files = glob(glob_path)
+            if not src_files:
+                logging.error('No Red Hat meta files found in metadata repo')
+                raise ConfigurationError('No Red Hat meta files found in metadata repo')
+            dest_dir = os.path.join(self._conf_dir, 'redhat', 'metadata')
+            if not os.path.exists(dest_dir):
+                os.makedirs(dest_dir)
+            # both sides are compared by git blob IDs, only files modified
+            # in the worktree of config repo are hashed
+            src_blobs = git_blob_ids(mirror_dir, conf['relpath'])
+            dest_blobs = git_blob_ids(self._conf_dir, os.path.join('redhat', 'metadata'))
+            copied = []
+            for src in src_files:
+                name = os.path.basename(src)
+                dest = os.path.join(dest_dir, name)
+                if os.path.isfile(dest):
+                    src_blob = src_blobs.get(name) or git_blob_digest(src)
+                    dest_blob = dest_blobs.get(name) or git_blob_digest(dest)
+                    if src_blob == dest_blob:
+                        continue
+                logging.debug('Copying Red Hat meta file "{0}" to "{1}"'.format(src, dest))
+                shutil.copy(src, dest)
+                copied.append(dest)
+            # files removed upstream must not mask layers any more
+            src_names = set(os.path.basename(src) for src in src_files)
+            removed = []
+            for dest in glob(os.path.join(dest_dir, '*.json')):
+                if os.path.basename(dest) not in src_names:
+                    logging.debug('Removing Red Hat meta file "{0}" deleted in metadata repo'.format(dest))
+                    os.remove(dest)
+                    removed.append(dest)
+        finally:
+            lock.release()
+        self._changed_files.extend(copied)
+        self._removed_files.extend(removed)
+        if self._redhat_image_index:
+            self._redhat_image_index.refresh(self.redhat_meta_files)
+        else:
+            self.redhat_image_ids
+        logging.info('Synced {0} changed Red Hat meta files: {1}, removed {2}: {3}'
+                .format(len(copied), copied, len(removed), removed))
+        stdprint('Synced {0} changed Red Hat meta files, removed {1}'.format(len(copied), len(removed)))
+        return copied + removed
+
+    @timed('config.clone')
+    def _clone_config_repo(self, repo_url):
+        """Use cached clone of config repo, fall back to temporary clone
+        when the cached one is used by another raas process"""
+        from git import Repo
+        from git.exc import GitCommandError
+        self._push_branch = self.config_branch
+        self._repo_url = repo_url
+        key = hashlib.sha1('{0}#{1}'.format(repo_url, self.config_branch)).hexdigest()
+        self._conf_dir = os.path.join(cache_dir('config'), key)
+        self._cache_lock = CacheLock(self._conf_dir)
+        # flush must push the outbox of the cached clone, so it waits for it
+        if self._cache_lock.acquire(blocking=self._action == 'flush'):
+            if self._cache_lock.first:
+                try:
+                    self._config_repo = sync_git_mirror(repo_url, self.config_branch, self._conf_dir)
+                except GitCommandError as e:
+                    logging.error('Failed to clone config repo: {0}'.format(e))
+                    raise ConfigurationError('Failed to clone config repo')
+            else:
+                self._config_repo = Repo(self._conf_dir)
+            logging.info('Using cached config repo "{0}"'.format(self._conf_dir))
+        else:
+            self._cache_lock = None
+            self._temp_clone = True
+            self._conf_dir = mkdtemp()
+            logging.info('Cached config repo is in use, clonning config repo from "{0}:{1}" to "{2}"'.format(
+                    repo_url, self.config_branch, self._conf_dir))
+            self._config_repo = Repo.clone_from(repo_url, self._conf_dir,
+                    branch=self.config_branch, depth=1)
+        self._setup_union_merge()
+
+    def _setup_union_merge(self):
+        """Let concurrent runs append to the same log file without rebase conflicts"""
+        attributes = os.path.join(self._config_repo.git_dir, 'info', 'attributes')
+        if os.path.isfile(attributes):
+            return
+        if not os.path.isdir(os.path.dirname(attributes)):
+            os.makedirs(os.path.dirname(attributes))
+        with open(attributes, 'w') as f:
+            f.write('*.log merge=union\n')
 
+    def cleanup(self):
+        self.close_log()
+        if self._cache_lock:
+            self._cache_lock.release()
+            self._cache_lock = None
+
+    @timed('config.commit')
     def commit_all_changes(self):
         if self._config_repo:
             logging.info('Committing changes in config repo')
-            files = [self._conf_file, self.logfile]
+            self.close_log()
+            files = [self._conf_file, self.logfile] + self._changed_files
             if self.isv_app_name and os.path.isfile(self.metafile):
                 files.append(self.metafile)
+            for f in self._removed_files:
+                self._config_repo.git.rm('--cached', '--ignore-unmatch', '--quiet', f)
             self._config_repo.index.add(files)
             self._config_repo.index.commit('{0} {1} {2}update by raas script'\
-                    .format(self.isv, self._action, self.isv_app_name + ' ' if self.isv_app_name else ''))
-            self._config_repo.remotes.origin.push()
+                    .format(self.isv or 'redhat', self._action, self.isv_app_name + ' ' if self.isv_app_name else ''))
+            # temporary clone is removed with its outbox, push it right away
+            if self._push == 'now' or self._temp_clone:
+                self.flush()
+            elif self._push == 'background':
+                self.flush_in_background()
+            else:
+                logging.info('Config repo changes are kept in outbox, run "raas flush" to push them')
+                stdprint('Config repo changes are kept in outbox, run "raas flush" to push them')
+
+    @timed('config.push')
+    def flush(self):
+        """Push outbox (local commits) of config repo to origin.
+
+        Rejected push is retried after rebasing the outbox onto changes
+        pushed by concurrent runs.
+        """
+        from git.exc import GitCommandError
+        if not self._config_repo:
+            logging.info('No config repo to flush')
+            return 0
+        branch = self._push_branch
+        ahead = int(self._config_repo.git.rev_list('--count', 'origin/{0}..HEAD'.format(branch)))
+        for attempt in range(1, self._PUSH_RETRIES + 1):
+            if not ahead:
+                logging.info('Config repo outbox is empty')
+                return 0
+            try:
+                logging.info('Pushing {0} commits of config repo to "origin/{1}"'.format(ahead, branch))
+                self._config_repo.git.push('origin', 'HEAD:refs/heads/' + branch)
+                logging.info('Pushed {0} commits of config repo'.format(ahead))
+                stdprint('Pushed {0} configuration changes'.format(ahead))
+                return ahead
+            except GitCommandError as e:
+                logging.warn('Push of config repo failed ({0}/{1}): {2}'.format(attempt, self._PUSH_RETRIES, e))
+                sleep(attempt)
+                try:
+                    ahead = fetch_and_rebase(self._config_repo, branch)
+                except GitCommandError as e:
+                    logging.warn('Failed to fetch config repo: {0}'.format(e))
+        logging.error('Failed to push config repo changes, they are kept in outbox "{0}"'.format(self._conf_dir))
+        raise ConfigurationError('Failed to push config repo changes')
+
+    def flush_in_background(self):
+        """Release cached config repo and push it from detached raas process"""
+        self.cleanup()
+        cmd = [sys.executable, os.path.abspath(__file__), '--configenv', self.config_branch, 'flush']
+        logging.info('Pushing config repo changes in background: {0}'.format(' '.join(cmd)))
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen(cmd, cwd=os.getcwd(), stdin=devnull, stdout=devnull,
+                    stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+
+    def _compress_old_logs(self):
+        """Gzip log files of completed days, they are committed as
+        <day>.<host>-<run>.log.gz.
+
+        Each run writes its own compressed file, so concurrent runs (cached
+        and temporary clone, other hosts) never change the same tracked file.
+        Yesterday's log is left for late appends of runs started before midnight.
+        """
+        yesterday = (date.today() - timedelta(days=1)).isoformat() + '.log'
+        for l_file in glob(os.path.join(self._logdir, '*.log')):
+            if os.path.basename(l_file) >= yesterday:
+                continue
+            gz_file = '{0}.{1}-{2}.log.gz'.format(l_file[:-len('.log')],
+                    socket.gethostname().split('.')[0], log_payload.run_id)
+            logging.info('Compressing log file "{0}" to "{1}"'.format(l_file, gz_file))
+            with open(l_file, 'rb') as f_in:
+                gz = gzip.open(gz_file, 'ab')
+                try:
+                    shutil.copyfileobj(f_in, gz)
+                finally:
+                    gz.close()
+            os.remove(l_file)
+            self._changed_files.append(gz_file)
+            self._removed_files.append(l_file)
+
+    @property
+    def payload_store_dir(self):
+        """Local-only dir for full log payloads of this run"""
+        store = cache_dir('payloads', self.isv if self.isv else 'redhat')
+        prune_dated_dirs(store, self._PAYLOAD_KEEP_DAYS)
+        return cache_dir('payloads', self.isv if self.isv else 'redhat', date.today().isoformat())
 
     def _setup_isv_config_dirs(self):
-        self._logdir = os.path.join(self._conf_dir, self.isv, 'logs')
-        self._metadir = os.path.join(self._conf_dir, self.isv, 'metadata')
+        # actions without ISV use logs and metadata of Red Hat
+        isv_dir = os.path.join(self._conf_dir, self.isv if self.isv else 'redhat')
+        self._logdir = os.path.join(isv_dir, 'logs')
+        self._metadir = os.path.join(isv_dir, 'metadata')
         if not os.path.exists(self._logdir):
             logging.info('Creating log dir "{0}"'.format(self._logdir))
             os.makedirs(self._logdir)
@@ -1340,10 +3723,12 @@ class Configuration(object):
             except ValueError as e:
                 logging.error('"verify_ssl" option in "pulpserver" section is not a boolean: {0}'.format(e))
                 raise ConfigurationError('"verify_ssl" option in "pulpserver" section is not a boolean')
+            # limits are applied to governors shared by all jobs, reject bad ones early
+            self.limits_conf
             if only_main_sections:
                 return
             for s in self._parsed_config.sections():
-                if s in ['openshift', 'aws', 'pulpserver']:
+                if s in self._MAIN_SECTIONS:
                     continue
                 for o in ['openshift_domain', 'openshift_app', 'openshift_scale', 'openshift_gear_size', 's3_bucket']:
                     if not self._parsed_config.get(s, o):
@@ -1370,6 +3755,776 @@ class RaasError(Exception):
     pass
 
 
+def init_backends(config, action):
+    """Return (pulp, aws, openshift) clients needed by action, None for unused ones"""
+    pulp = aws = openshift = None
+    Governor.configure_all(config.limits_conf)
+    if action in ['status', 'setup', 'publish']:
+        try:
+            openshift = Openshift(**config.openshift_conf)
+        except OpenshiftError as e:
+            logging.critical('Failed to initialize Openshift: {0}'.format(e))
+            raise RaasError('Failed to initialize Openshift')
+
+        try:
+            aws = AwsS3(**config.aws_conf)
+        except AwsError as e:
+            logging.critical('Failed to initialize AWS: {0}'.format(e))
+            raise RaasError('Failed to initialize AWS')
+
+    if action in ['status', 'setup', 'publish', 'pulp-upload']:
+        try:
+            pulp = PulpServer(**config.pulp_conf)
+        except PulpError as e:
+            logging.critical('Failed to initialize Pulp: {0}'.format(e))
+            raise RaasError('Failed to initialize Pulp')
+    return pulp, aws, openshift
+
+
+def cleanup_backends(pulp, openshift):
+    if openshift:
+        openshift.cleanup()
+    if pulp:
+        pulp.cleanup()
+
+
+def run_status(config, pulp, aws, openshift, check_pulp=False):
+    """Check status of ISV (and its app) backends"""
+    ret = 0
+    try:
+        if check_pulp:
+            pulp.status()
+            pulp.remove_orphan_content()
+            if config.isv_app_name:
+                pulp.verify_repo()
+        aws.status()
+        openshift.status()
+        if config.isv_app_name:
+            if openshift.image_ids == aws.image_ids:
+                logging.info('Openshift crane images matches AWS images')
+                stdprint('Openshift crane images matches AWS images')
+            else:
+                logging.error('Openshift Crane images does not match AWS images:\nCrane: {0}\nAWS: {1}'\
+                        .format(openshift.image_ids, aws.image_ids))
+                raise RaasError('Openshift crane images and AWS images do not match')
+        logging.info('Status of "{0}" is OK'.format(config.isv))
+        stdprint('Status of "{0}" is OK'.format(config.isv))
+        if config.isv_app_name:
+            stdprint('To pull this image with docker, use:\n# docker pull {0}'.format(openshift.docker_pull_url()))
+            stdprint(openshift.docker_pull_url(), True)
+        else:
+            isv_apps = openshift.get_list_of_isv_apps()
+            if not isv_apps:
+                stdprint('This ISV has no published docker images')
+            else:
+                stdprint('Published docker images of this ISV:\n - {0}'.format('\n - '.join(isv_apps)))
+                stdprint('\n'.join(isv_apps), True)
+    except RaasError as e:
+        logging.error('Failed to verify "{0}" status: {1}'.format(config.isv, e))
+        ret = 1
+    except AwsError as e:
+        logging.error('Failed to verify AWS status: {0}'.format(e))
+        ret = 1
+    except OpenshiftError as e:
+        logging.error('Failed to verify openshift status: {0}'.format(e))
+        ret = 1
+    except PulpError as e:
+        logging.error('Failed to verify pulp status: {0}'.format(e))
+        ret = 1
+    except IOError as e:
+        logging.error('I/O error: {0}'.format(e))
+        ret = 1
+    return ret
+
+
+def run_setup(config, aws, openshift):
+    """Setup S3 bucket and openshift crane app of ISV"""
+    ret = 0
+    try:
+        aws.create_bucket()
+        openshift.create_domain()
+        openshift.create_app(config.redhat_meta_files)
+        logging.info('ISV "{0}" was setup correctly'.format(config.isv))
+        stdprint('ISV "{0}" was setup correctly'.format(config.isv))
+    except AwsError as e:
+        logging.error('Failed to setup S3 bucket: {0}'.format(e))
+        ret = 1
+    except OpenshiftError as e:
+        logging.error('Failed to setup openshift: {0}'.format(e))
+        ret = 1
+    except IOError as e:
+        logging.error('I/O error: {0}'.format(e))
+        ret = 1
+    return ret
+
+
+def prepare_crane_app(openshift):
+    openshift.verify_domain()
+    openshift.verify_app()
+    openshift.clone_app()
+
+
+def transfer_layers(journal, pulp, aws, redhat_image_ids):
+    """Download layers from pulp and upload them to S3, skip stages completed in journal"""
+    if journal.done('download') and os.path.isfile(pulp.crane_config_file) and journal.verify_layers():
+        logging.info('Using image downloaded by previous publish')
+        stdprint('Using image downloaded by previous publish')
+        files = pulp.files_for_aws(redhat_image_ids)
+    else:
+        # files uploaded from the same export are kept (keys are "<image_id>/<file>"),
+        # a failed upload stops the download, so it is not complete on resume
+        journal.forget('download', 'layers')
+        if journal.done('export'):
+            logging.info('Using pulp export of previous publish, tasks: {0}'.format(journal.get('export')))
+        else:
+            # new export may differ from the uploaded files
+            journal.forget('uploaded')
+            journal.record('export', pulp.export_repo(aws.app_url))
+        files = pulp.download_files_for_aws(aws.app_url, redhat_image_ids, export=False, progress=journal)
+    uploaded = journal.get('uploaded', {})
+    if uploaded:
+        # files may have been removed from the bucket since
+        found = aws.existing_files(uploaded)
+        if len(found) < len(uploaded):
+            logging.warn('{0} files uploaded to S3 by previous publish are missing, uploading them again'.format(
+                    len(uploaded) - len(found)))
+        uploaded = found
+        logging.info('Skipping {0} files uploaded to S3 by previous publish'.format(len(uploaded)))
+    try:
+        aws.upload_layers(((name, path) for name, path in files if name not in uploaded), journal.uploaded)
+    finally:
+        # stops the download when upload failed
+        files.close()
+
+
+def run_publish(config, pulp, aws, openshift, restart=False):
+    """Publish ISV app from pulp to S3 and openshift crane app.
+
+    Layers are uploaded to S3 as soon as they are downloaded and extracted,
+    crane app is verified and cloned meanwhile. Completed stages are recorded
+    in publish journal, failed publish resumes from the first incomplete stage
+    unless restart is True.
+    """
+    ret = 0
+    journal = None
+    try:
+        journal = PublishJournal(config.isv, config.isv_app_name, restart)
+        pulp.data_dir = journal.data_dir
+        crane = BackgroundTask('raas-crane-prepare', prepare_crane_app, openshift)
+        try:
+            transfer_layers(journal, pulp, aws, config.redhat_image_ids)
+        finally:
+            crane.join()
+        crane.result()
+        if journal.done('crane'):
+            logging.info('Crane app updated by previous publish in commit "{0}"'.format(journal.get('crane')))
+        else:
+            journal.record('crane', openshift.update_app([pulp.crane_config_file]))
+        config.metafile = openshift.isv_app_crane_file
+        journal.complete()
+        journal = None
+        logging.info('Published "{0}" image'.format(config.isv_app_name))
+        stdprint('Published "{0}" image'.format(config.isv_app_name))
+        stdprint('To pull this image with docker, use:\n# docker pull {0}'.format(openshift.docker_pull_url()))
+        stdprint(openshift.docker_pull_url(), True)
+    except PulpError as e:
+        logging.error('Failed to download repo from pulp: {0}'.format(e))
+        ret = 1
+    except AwsError as e:
+        logging.error('Failed to upload images to AWS: {0}'.format(e))
+        ret = 1
+    except OpenshiftError as e:
+        logging.error('Failed to update openshift app: {0}'.format(e))
+        ret = 1
+    except ConfigurationError as e:
+        logging.error('Failed to publish: {0}'.format(e))
+        ret = 1
+    except IOError as e:
+        logging.error('I/O error: {0}'.format(e))
+        ret = 1
+    finally:
+        if journal:
+            journal.close()
+    return ret
+
+
+def run_pulp_upload(config, pulp, workers=4):
+    """Upload image tarballs of ISV apps to pulp.
+
+    Every repository in the tarballs is uploaded to its own pulp repo, up to
+    workers uploads run concurrently.
+    """
+    uploads = []
+    try:
+        pulp.status()
+        repositories = set()
+        for file_upload in config.file_upload:
+            for client in pulp.image_uploads(file_upload):
+                uploads.append((client, file_upload))
+                if client.repo_id in repositories:
+                    logging.error('Pulp repository "{0}" is uploaded from several images'.format(client.repo_id))
+                    raise PulpError('Pulp repository "{0}" is uploaded from several images'.format(client.repo_id))
+                repositories.add(client.repo_id)
+        if config.isv_app_name and len(uploads) > 1:
+            logging.error('ISV app name can be used only with one uploaded image')
+            raise PulpError('ISV app name can be used only with one uploaded image')
+        redhat_image_ids = config.redhat_image_ids
+    except (PulpError, IOError) as e:
+        logging.error('Failed to prepare images for pulp upload: {0}'.format(e))
+        for client, _ in uploads:
+            client.cleanup()
+        return 1
+
+    @in_current_context
+    def upload(item):
+        client, file_upload = item
+        try:
+            if client.upload_image(file_upload, redhat_image_ids, check_status=False):
+                # publish of the previous image must not be resumed
+                PublishJournal.discard(config.isv, client.isv_app_name)
+            return 0
+        except PulpError as e:
+            logging.error('Failed to upload "{0}" from "{1}" to pulp: {2}'.format(client.isv_app_name, file_upload, e))
+        except IOError as e:
+            logging.error('I/O error: {0}'.format(e))
+        return 1
+
+    if len(uploads) > 1:
+        logging.info('Uploading {0} repositories to pulp with {1} workers'.format(len(uploads), workers))
+    pool = ThreadPool(max(1, min(workers, len(uploads))))
+    try:
+        results = pool.map(upload, uploads)
+    finally:
+        pool.close()
+        pool.join()
+        # clients of repositories in the same image share its data, the first one removes it
+        for client, _ in uploads:
+            client.cleanup()
+    return max(results)
+
+
+def run_redhat_sync(config):
+    """Sync Red Hat crane metadata to config repo"""
+    ret = 0
+    try:
+        config.sync_redhat_meta()
+    except ConfigurationError as e:
+        logging.error('Failed to sync Red Hat metadata: {0}'.format(e))
+        ret = 1
+    except IOError as e:
+        logging.error('I/O error: {0}'.format(e))
+        ret = 1
+    return ret
+
+
+def run_action(action, config, pulp, aws, openshift, check_pulp=False, restart=False, workers=4):
+    """Run action with initialized backends, return exit code"""
+    if action == 'status':
+        return run_status(config, pulp, aws, openshift, check_pulp)
+    elif action == 'setup':
+        return run_setup(config, aws, openshift)
+    elif action == 'publish':
+        return run_publish(config, pulp, aws, openshift, restart)
+    elif action == 'pulp-upload':
+        return run_pulp_upload(config, pulp, workers)
+    elif action == 'redhat-sync':
+        return run_redhat_sync(config)
+    logging.error('Unknown action "{0}"'.format(action))
+    return 1
+
+
+class IsvLogFilter(logging.Filter):
+    """Pass only records logged while working on the ISV (see log_context)"""
+
+    def __init__(self, isv):
+        logging.Filter.__init__(self)
+        self._isv = isv
+
+    def filter(self, record):
+        if not hasattr(record, 'isv'):
+            record.isv = getattr(log_context, 'isv', None)
+        return record.isv == self._isv
+
+
+def read_publish_manifest(filename):
+    """Return list of (isv, app) from JSON lines manifest"""
+    items = []
+    with open(filename) as f:
+        for num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                data = json.loads(line)
+                items.append((data['isv'], data.get('app') or data['isv_app']))
+            except (ValueError, KeyError, TypeError) as e:
+                logging.error('Invalid line {0} of manifest "{1}": {2}'.format(num, filename, e))
+                raise RaasError('Invalid manifest line {0}'.format(num))
+    if not items:
+        logging.error('Manifest "{0}" has no items'.format(filename))
+        raise RaasError('Empty manifest')
+    return items
+
+
+def _publish_batch_item(config, app, redhat_image_ids):
+    """Download app from pulp and upload its layers to S3, return (result, pulp)"""
+    log_context.isv = config.isv
+    result = {'isv': config.isv, 'app': app, 'state': 'failed', 'error': None, 'stages': {}}
+    start = time()
+    pulp = None
+    try:
+        pulp_conf = config.pulp_conf
+        pulp_conf['isv_app_name'] = app
+        pulp = PulpServer(**pulp_conf)
+        aws_conf = config.aws_conf
+        aws_conf['app_name'] = app
+        aws = AwsS3(**aws_conf)
+        stage = time()
+        aws.upload_layers(pulp.download_files_for_aws(aws.app_url, redhat_image_ids))
+        result['stages']['transfer'] = time() - stage
+        result['state'] = 'uploaded'
+    except (PulpError, AwsError, ConfigurationError, IOError) as e:
+        logging.error('Failed to publish "{0}" of "{1}": {2}'.format(app, config.isv, e))
+        result['error'] = str(e)
+    result['duration'] = time() - start
+    log_context.isv = None
+    return result, pulp
+
+
+def publish_batch(args, log_handler):
+    """Publish apps listed in manifest, grouped by ISV, in a worker pool.
+
+    Apps are downloaded and uploaded to S3 concurrently, crane app of each ISV
+    is cloned, updated and pushed only once.
+    """
+    start = time()
+    if args.workers < 1:
+        logging.critical('Number of workers must be at least 1')
+        return 1
+    stats = RunStats(args.action)
+    log_context.stats = stats
+    try:
+        items = read_publish_manifest(args.manifest)
+    except (RaasError, IOError) as e:
+        logging.critical('Failed to read manifest: {0}'.format(e))
+        return 1
+    groups = {}
+    for isv, app in items:
+        groups.setdefault(isv, []).append(app)
+
+    log_payload.max_size = args.payload_max
+    pool = ThreadPool(args.workers)
+    results = []
+    batches = []
+
+    def fail(batch, error):
+        logging.error('Failed to prepare publishing for "{0}": {1}'.format(batch['isv'], error))
+        for app in batch['apps']:
+            results.append({'isv': batch['isv'], 'app': app, 'state': 'failed', 'error': str(error),
+                    'stages': {}, 'duration': 0})
+        batch['config'] = None
+
+    def verify(batch):
+        log_context.isv = batch['config'].isv
+        try:
+            batch['openshift'].verify_domain()
+            batch['openshift'].verify_app()
+        except (ConfigurationError, OpenshiftError, ValueError, IOError) as e:
+            # error of one ISV (e.g. broken connection to its crane app) fails only its apps
+            return e
+
+    for isv in sorted(groups):
+        log_context.isv = isv.lower()
+        batch = {'isv': isv, 'apps': groups[isv], 'config': None, 'openshift': None, 'pending': []}
+        batches.append(batch)
+        try:
+            config = Configuration(isv, args.configenv, args.action, push='defer')
+            batch['config'] = config
+            Governor.configure_all(config.limits_conf)
+            apps = []
+            for app in groups[isv]:
+                try:
+                    config.isv_app_name = app
+                    apps.append(config.isv_app_name)
+                except ValueError as e:
+                    results.append({'isv': isv, 'app': app, 'state': 'failed', 'error': str(e),
+                            'stages': {}, 'duration': 0})
+            config.isv_app_name = None
+            batch['apps'] = apps
+            config.open_log(log_handler, logging.Formatter(
+                    '%(asctime)s - PUBLISH-BATCH - %(name)s - %(levelname)s - %(message)s'), isv_only=True)
+            batch['openshift'] = Openshift(**config.openshift_conf)
+        except (ConfigurationError, OpenshiftError, ValueError, IOError) as e:
+            fail(batch, e)
+
+    # domains and crane apps of all ISVs are checked at once
+    log_context.isv = None
+    prepared = [b for b in batches if b['config']]
+    for batch, error in zip(prepared, fan_out(verify, prepared)):
+        config = batch['config']
+        log_context.isv = config.isv
+        if error:
+            fail(batch, error)
+            continue
+        try:
+            batch['openshift'].clone_app()
+            redhat_image_ids = config.redhat_image_ids
+        except (ConfigurationError, OpenshiftError, IOError) as e:
+            fail(batch, e)
+            continue
+        for app in batch['apps']:
+            batch['pending'].append(pool.apply_async(in_current_context(_publish_batch_item),
+                    (config, app, redhat_image_ids)))
+    log_context.isv = None
+    pool.close()
+
+    for batch in batches:
+        config = batch['config']
+        if not config:
+            continue
+        log_context.isv = config.isv
+        openshift = batch['openshift']
+        done = [r.get() for r in batch['pending']]
+        uploaded = [(result, pulp) for result, pulp in done if result['state'] == 'uploaded']
+        try:
+            if uploaded:
+                stage = time()
+                openshift.update_app([pulp.crane_config_file for _, pulp in uploaded])
+                crane_time = time() - stage
+                for result, pulp in uploaded:
+                    config.metafile = pulp.crane_config_file
+                    result['state'] = 'published'
+                    result['stages']['crane'] = crane_time
+                    result['pull_url'] = openshift.docker_pull_url(result['app'])
+        except (OpenshiftError, ConfigurationError, IOError) as e:
+            logging.error('Failed to update openshift app of "{0}": {1}'.format(config.isv, e))
+            for result, _ in uploaded:
+                result['state'] = 'failed'
+                result['error'] = str(e)
+        for result, pulp in done:
+            if pulp:
+                pulp.cleanup()
+            results.append(result)
+        openshift.cleanup()
+        if not args.nocommit:
+            try:
+                config.commit_all_changes()
+            except ConfigurationError as e:
+                logging.error('Failed to commit configuration changes of "{0}": {1}'.format(config.isv, e))
+        log_context.isv = None
+    pool.join()
+
+    configs = [b['config'] for b in batches if b['config']]
+    ret = 0
+    if configs and not args.nocommit:
+        try:
+            if args.push == 'now':
+                configs[-1].flush()
+            elif args.push == 'background':
+                configs[-1].flush_in_background()
+        except ConfigurationError as e:
+            logging.error('Failed to push configuration changes: {0}'.format(e))
+            ret = 1
+    for config in configs:
+        config.cleanup()
+
+    failed = [r for r in results if r['state'] != 'published']
+    summary = {'duration' : time() - start,
+               'workers'  : args.workers,
+               'published': len(results) - len(failed),
+               'failed'   : len(failed),
+               'items'    : results}
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+        logging.info('Publish batch summary written to "{0}"'.format(args.summary))
+    for r in results:
+        stdprint('{0:<10} {1:<16} {2:<40} {3:7.1f}s {4}'.format(r['state'], r['isv'], r['app'],
+                r['duration'], r['error'] or r.get('pull_url', '')))
+        if r['state'] == 'published':
+            stdprint(r['pull_url'], True)
+    stdprint('Published {0} of {1} apps in {2:.1f} seconds'.format(
+            summary['published'], len(results), summary['duration']))
+    if failed:
+        ret = 1
+    stats.save(report_file('batch', args.action), args.metrics, ret)
+    if args.stats:
+        stdprint(stats.summary())
+    return ret
+
+
+class RaasService(object):
+    """Job queue of raas service mode.
+
+    Jobs run one by one in a worker thread, which keeps configuration of each
+    ISV, backend connections, cloned openshift apps and the Red Hat image ID
+    index warm between jobs.
+    """
+
+    _ACTIONS           = ['status', 'publish', 'pulp-upload']
+    _MAX_FINISHED_JOBS = 1000
+
+    def __init__(self, config_branch, push, nocommit, log_handler, payload_max):
+        self._config_branch = config_branch
+        self._push = push
+        self._nocommit = nocommit
+        self._log_handler = log_handler
+        self._payload_max = payload_max
+        self._jobs = {}
+        self._finished = []
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count(1)
+        self._queue = Queue.Queue()
+        self._configs = {}
+        self._openshift_clients = {}
+        self._worker = threading.Thread(target=self._work, name='raas-job-worker')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, request):
+        """Queue job described by request dict, return the job"""
+        return self.submit_all([request])[0]
+
+    def submit_all(self, requests):
+        """Queue jobs described by list of request dicts, return the jobs.
+
+        All requests are validated first, none is queued if any is invalid.
+        """
+        jobs = [self._new_job(r) for r in requests]
+        with self._lock:
+            for job in jobs:
+                job['id'] = str(next(self._job_ids))
+                self._jobs[job['id']] = job
+        for job in jobs:
+            self._queue.put(job)
+            logging.info('Queued job "{0}": {1} {2} {3}'.format(
+                    job['id'], job['action'], job['isv'], job['isv_app'] or ''))
+        return jobs
+
+    def _new_job(self, request):
+        if not isinstance(request, dict):
+            raise ValueError('Job must be a JSON object')
+        action = request.get('action')
+        if action not in self._ACTIONS:
+            raise ValueError('Job action must be one of: {0}'.format(', '.join(self._ACTIONS)))
+        if not request.get('isv'):
+            raise ValueError('Job "isv" is required')
+        if action == 'publish' and not request.get('isv_app'):
+            raise ValueError('Job "isv_app" is required for publish')
+        file_upload = request.get('file_upload')
+        if isinstance(file_upload, basestring):
+            file_upload = [file_upload]
+        if action == 'pulp-upload' and not file_upload:
+            raise ValueError('Job "file_upload" is required for pulp-upload')
+        return {'id'         : None,
+                'action'     : action,
+                'isv'        : request['isv'],
+                'isv_app'    : request.get('isv_app'),
+                'file_upload': file_upload,
+                'pulp'       : bool(request.get('pulp')),
+                'restart'    : bool(request.get('restart')),
+                'state'      : 'queued',
+                'submitted'  : time(),
+                'started'    : None,
+                'finished'   : None,
+                'ret'        : None,
+                'progress'   : [],
+                'output'     : []}
+
+    def job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: int(j['id']))
+
+    @property
+    def queue_length(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job['state'] = 'running'
+            job['started'] = time()
+            try:
+                job['ret'] = self._run_job(job)
+            except Exception as e:
+                logging.exception('Job "{0}" crashed: {1}'.format(job['id'], e))
+                job['ret'] = 1
+            job['finished'] = time()
+            job['state'] = 'finished' if job['ret'] == 0 else 'failed'
+            logging.info('Job "{0}" {1} in {2:.1f} seconds'.format(
+                    job['id'], job['state'], job['finished'] - job['started']))
+            with self._lock:
+                self._finished.append(job['id'])
+                while len(self._finished) > self._MAX_FINISHED_JOBS:
+                    del self._jobs[self._finished.pop(0)]
+
+    def _collect_output(self, job):
+        def sink(msg, terse_msg):
+            (job['output'] if terse_msg else job['progress']).append(msg)
+        return sink
+
+    def _configuration(self, job):
+        """Reuse configuration of the ISV (and its cached clone of config repo)"""
+        key = (job['isv'].lower(), self._config_branch)
+        config = self._configs.pop(key, None)
+        if config:
+            try:
+                if not config.reuse(job['action'], isv_app_name=job['isv_app'], file_upload=job['file_upload']):
+                    config = None
+            except (ConfigurationError, ValueError, IOError):
+                config.cleanup()
+                raise
+        if not config:
+            config = Configuration(job['isv'], self._config_branch, job['action'],
+                    isv_app_name=job['isv_app'], file_upload=job['file_upload'], push=self._push)
+        self._configs[key] = config
+        return config
+
+    def _openshift(self, config):
+        """Reuse openshift client (and its cloned app) of the ISV"""
+        conf = config.openshift_conf
+        key = tuple(sorted((k, v) for k, v in conf.items() if k not in ['isv_app_name', 'create']))
+        openshift = self._openshift_clients.get(key)
+        if openshift:
+            openshift.reset(conf['isv_app_name'])
+        else:
+            openshift = Openshift(**conf)
+            self._openshift_clients[key] = openshift
+        return openshift
+
+    def _run_job(self, job):
+        stdprint.local.sink = self._collect_output(job)
+        log_context.isv = job['isv'].lower()
+        log_context.stats = RunStats(job['action'], log_context.isv, job['id'])
+        try:
+            config = self._configuration(job)
+        except (ConfigurationError, ValueError, IOError) as e:
+            logging.error('Failed to initialize job "{0}": {1}'.format(job['id'], e))
+            job['progress'].append('Failed to initialize job: {0}'.format(e))
+            log_context.stats = None
+            return 1
+        Governor.configure_all(config.limits_conf)
+
+        config.open_log(self._log_handler, logging.Formatter(
+                '%(asctime)s - {0} - %(name)s - %(levelname)s - %(message)s'.format(job['action'].upper())), isv_only=True)
+        log_payload.store_dir = config.payload_store_dir if self._payload_max else None
+        ret = 1
+        try:
+            try:
+                pulp = PulpServer(**config.pulp_conf)
+                aws = openshift = None
+                if job['action'] != 'pulp-upload':
+                    openshift = self._openshift(config)
+                    aws = AwsS3(**config.aws_conf)
+            except (PulpError, AwsError, OpenshiftError) as e:
+                logging.error('Failed to initialize backends of job "{0}": {1}'.format(job['id'], e))
+                return ret
+            logging.info('Running "{0}" action of job "{1}"'.format(job['action'], job['id']))
+            ret = run_action(job['action'], config, pulp, aws, openshift, check_pulp=job['pulp'], restart=job['restart'])
+            pulp.cleanup()
+            if not self._nocommit:
+                try:
+                    config.commit_all_changes()
+                except ConfigurationError as e:
+                    logging.error('Failed to commit configuration changes: {0}'.format(e))
+                    ret = 1
+            return ret
+        finally:
+            config.close_log()
+            log_context.stats.save(report_file(config.isv, job['action'], job['id']), ret=ret)
+            log_context.stats = None
+            config.cleanup()
+            log_context.isv = None
+
+    def cleanup(self):
+        for openshift in self._openshift_clients.values():
+            openshift.cleanup()
+
+
+class RaasRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """HTTP/JSON API of raas service
+
+    GET  /status      service status and queue length
+    GET  /jobs        list of jobs
+    GET  /jobs/<id>   job state, progress messages and output
+    POST /jobs        queue job (or list of jobs), for example
+                      {"action": "publish", "isv": "acme", "isv_app": "acme/app"}
+    """
+
+    def _send_json(self, code, data):
+        body = json.dumps(data, indent=2)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        path = self.path.rstrip('/')
+        if path == '/status':
+            self._send_json(200, {'status': 'ok', 'queued': service.queue_length})
+        elif path == '/jobs':
+            self._send_json(200, [dict((k, v) for k, v in j.items() if k not in ['progress', 'output'])
+                    for j in service.jobs()])
+        elif path.startswith('/jobs/'):
+            job = service.job(path[len('/jobs/'):])
+            if job:
+                self._send_json(200, job)
+            else:
+                self._send_json(404, {'error': 'Job not found'})
+        else:
+            self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self._send_json(404, {'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            request = json.loads(self.rfile.read(length))
+            if isinstance(request, list):
+                jobs = self.server.service.submit_all(request)
+            else:
+                jobs = self.server.service.submit(request)
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        self._send_json(202, jobs)
+
+    def log_message(self, format, *args):
+        logging.info('HTTP request from {0}: {1}'.format(self.client_address[0], format % args))
+
+
+class RaasHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(args, log_handler):
+    """Run raas service with local HTTP/JSON API"""
+    service = RaasService(args.configenv, args.push, args.nocommit, log_handler, args.payload_max)
+    log_payload.max_size = args.payload_max
+    try:
+        server = RaasHTTPServer((args.listen, args.port), RaasRequestHandler)
+    except socket.error as e:
+        logging.critical('Failed to start raas service on {0}:{1}: {2}'.format(args.listen, args.port, e))
+        return 1
+    server.service = service
+    logging.info('raas service listening on http://{0}:{1}/'.format(args.listen, args.port))
+    stdprint('raas service listening on http://{0}:{1}/'.format(args.listen, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('Stopping raas service')
+    server.server_close()
+    service.cleanup()
+    return 0
+
+
 def main():
     """Entrypoint for script"""
     isv_args = ['isv']
@@ -1393,6 +4548,20 @@ def main():
             help='working configuration environment branch to use, for example: "dev", "test", "stage", "master" (production). Matches configuration repo branch. Default is "stage"')
     parser.add_argument('-t', '--terse', action='store_true',
             help='enable terse output - print only docker pull URLs')
+    parser.add_argument('--async-log', action='store_true',
+            help='format and write log messages in a background thread')
+    parser.add_argument('--metrics', metavar='FILE',
+            help='write metrics of the run to Prometheus textfile FILE (not in serve mode)')
+    parser.add_argument('--profile', nargs='?', const='cpu', choices=['cpu', 'memory'],
+            help='profile the action, "memory" adds peak RSS and live objects growth to CPU profile '
+                 '(default "cpu", not in serve mode)')
+    parser.add_argument('--stats', action='store_true',
+            help='print latency, retries and sizes of backend calls per endpoint at exit (not in serve mode)')
+    parser.add_argument('--payload-max', metavar='CHARS', type=int, default=4096,
+            help='maximum size of a backend payload in log file, longer payloads are kept only in local payload store; 0 disables the limit. Default is 4096')
+    parser.add_argument('-P', '--push', default='now',
+            choices=['now', 'background', 'defer'],
+            help='when to push configuration changes: "now" (default), "background" or "defer" (keep them in outbox for "flush" command)')
     subparsers = parser.add_subparsers(dest='action')
     status_parser = subparsers.add_parser('status',
             help='check configuration status')
@@ -1420,12 +4589,34 @@ def main():
             help='publish new or updated image')
     publish_parser.add_argument(*isv_args, **isv_kwargs)
     publish_parser.add_argument(*isv_app_args, **isv_app_kwargs)
+    publish_parser.add_argument('--restart', action='store_true',
+            help='ignore stages completed by previous failed publish of the image and start over')
     pulp_upload_parser = subparsers.add_parser('pulp-upload',
             help='upload image to pulp')
     pulp_upload_parser.add_argument(*isv_args, **isv_kwargs)
     pulp_upload_parser.add_argument(*isv_app_opt_args, **isv_app_kwargs)
-    pulp_upload_parser.add_argument('file_upload', metavar='IMAGE.tar',
-            help='file to upload to pulp server. Output of "docker save some/image > image.tar"')
+    pulp_upload_parser.add_argument('file_upload', metavar='IMAGE.tar', nargs='+',
+            help='files to upload to pulp server. Output of "docker save some/image > image.tar", all repositories in the files are uploaded')
+    pulp_upload_parser.add_argument('-w', '--workers', type=int, default=4,
+            help='number of repositories uploaded concurrently, default is 4')
+    subparsers.add_parser('redhat-sync',
+            help='sync Red Hat crane metadata from metadata repo')
+    subparsers.add_parser('flush',
+            help='push configuration changes kept in outbox')
+    batch_parser = subparsers.add_parser('publish-batch',
+            help='publish apps listed in manifest file')
+    batch_parser.add_argument('manifest', metavar='MANIFEST',
+            help='JSON lines file with ISVs and apps to publish, for example: {"isv": "acme", "app": "acme/app"}')
+    batch_parser.add_argument('-w', '--workers', type=int, default=4,
+            help='number of apps published concurrently, default is 4')
+    batch_parser.add_argument('-s', '--summary', metavar='FILE',
+            help='write JSON summary with per-app results and timings to FILE')
+    serve_parser = subparsers.add_parser('serve',
+            help='run as a service with local HTTP/JSON API for status, publish and pulp-upload jobs')
+    serve_parser.add_argument('--listen', metavar='ADDRESS', default='127.0.0.1',
+            help='address to listen on, default is "127.0.0.1"')
+    serve_parser.add_argument('--port', type=int, default=8080,
+            help='port to listen on, default is 8080')
     args = parser.parse_args()
 
     stdprint.terse = args.terse
@@ -1433,11 +4624,29 @@ def main():
     logFormatter = logging.Formatter('%(asctime)s - {0} - %(name)s - %(levelname)s - %(message)s'.format(args.action.upper()))
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
+    if args.async_log:
+        logHandler = QueueLogHandler()
+        logger.addHandler(logHandler)
+    else:
+        logHandler = logger
     consoleHandler = logging.StreamHandler()
     consoleHandler.setFormatter(logFormatter)
     consoleHandler.setLevel(getattr(logging, args.log.upper(), None))
-    logger.addHandler(consoleHandler)
-
+    logHandler.addHandler(consoleHandler)
+
+    if args.action == 'serve':
+        sys.exit(serve(args, logHandler))
+    elif args.action == 'publish-batch':
+        if args.profile:
+            profiler = ActionProfiler(args.profile == 'memory')
+            ret = profiler.run(publish_batch, args, logHandler)
+            profiler.save(run_file('profiles', 'batch', args.action, '.prof'))
+            sys.stderr.write(profiler.summary())
+            sys.exit(ret)
+        sys.exit(publish_batch(args, logHandler))
+
+    stats = RunStats(args.action, getattr(args, 'isv', None))
+    log_context.stats = stats
     try:
         config_kwargs = {}
         if hasattr(args, 'isv_app'):
@@ -1458,7 +4667,8 @@ def main():
             config_kwargs['s3bucket'] = args.s3bucket
         config_kwargs['config_branch'] = args.configenv
         config_kwargs['action'] = args.action
-        config = Configuration(args.isv, **config_kwargs)
+        config_kwargs['push'] = args.push
+        config = Configuration(getattr(args, 'isv', None), **config_kwargs)
     except ConfigurationError as e:
         logging.critical('Failed to initialize raas: {0}'.format(e))
         sys.exit(1)
@@ -1469,136 +4679,53 @@ def main():
         logging.critical('I/O error: {0}'.format(e))
         sys.exit(1)
 
-    fileHandler = logging.FileHandler(config.logfile)
-    fileHandler.setFormatter(logFormatter)
-    fileHandler.setLevel(logging.DEBUG)
-    logger.addHandler(fileHandler)
-
-    if args.action != 'pulp-upload':
+    if args.action == 'flush':
         try:
-            openshift = Openshift(**config.openshift_conf)
-        except OpenshiftError as e:
-            logging.critical('Failed to initialize Openshift: {0}'.format(e))
-            sys.exit(1)
+            config.flush()
+            ret = 0
+        except ConfigurationError as e:
+            logging.error('Failed to flush configuration changes: {0}'.format(e))
+            ret = 1
+        stats.save(report_file('redhat', args.action), args.metrics, ret)
+        if args.stats:
+            stdprint(stats.summary())
+        config.cleanup()
+        sys.exit(ret)
 
-        try:
-            aws = AwsS3(**config.aws_conf)
-        except AwsError as e:
-            logging.critical('Failed to initialize AWS: {0}'.format(e))
-            sys.exit(1)
+    config.open_log(logHandler, logFormatter)
+
+    log_payload.max_size = args.payload_max
+    if args.payload_max:
+        log_payload.store_dir = config.payload_store_dir
 
     try:
-        pulp = PulpServer(**config.pulp_conf)
-    except PulpError as e:
-        logging.critical('Failed to initialize Pulp: {0}'.format(e))
+        pulp, aws, openshift = init_backends(config, args.action)
+    except RaasError:
         sys.exit(1)
 
-    ret = 0
-
-    if args.action == 'status':
-        try:
-            if args.pulp:
-                pulp.status()
-                pulp.remove_orphan_content()
-                if config.isv_app_name:
-                    pulp.verify_repo()
-            aws.status()
-            openshift.status()
-            if config.isv_app_name:
-                if openshift.image_ids == aws.image_ids:
-                    logging.info('Openshift crane images matches AWS images')
-                    stdprint('Openshift crane images matches AWS images')
-                else:
-                    logging.error('Openshift Crane images does not match AWS images:\nCrane: {0}\nAWS: {1}'\
-                            .format(openshift.image_ids, aws.image_ids))
-                    raise RaasError('Openshift crane images and AWS images do not match')
-            logging.info('Status of "{0}" is OK'.format(config.isv))
-            stdprint('Status of "{0}" is OK'.format(config.isv))
-            if config.isv_app_name:
-                stdprint('To pull this image with docker, use:\n# docker pull {0}'.format(openshift.docker_pull_url()))
-                stdprint(openshift.docker_pull_url(), True)
-            else:
-                isv_apps = openshift.get_list_of_isv_apps()
-                if not isv_apps:
-                    stdprint('This ISV has no published docker images')
-                else:
-                    stdprint('Published docker images of this ISV:\n - {0}'.format('\n - '.join(isv_apps)))
-                    stdprint('\n'.join(isv_apps), True)
-        except RaasError as e:
-            logging.error('Failed to verify "{0}" status: {1}'.format(config.isv, e))
-            ret = 1
-        except AwsError as e:
-            logging.error('Failed to verify AWS status: {0}'.format(e))
-            ret = 1
-        except OpenshiftError as e:
-            logging.error('Failed to verify openshift status: {0}'.format(e))
-            ret = 1
-        except PulpError as e:
-            logging.error('Failed to verify pulp status: {0}'.format(e))
-            ret = 1
-        except IOError as e:
-            logging.error('I/O error: {0}'.format(e))
-            ret = 1
-
-    elif args.action == 'setup':
-        try:
-            aws.create_bucket()
-            openshift.create_domain()
-            openshift.create_app(config.redhat_meta_files)
-            logging.info('ISV "{0}" was setup correctly'.format(config.isv))
-            stdprint('ISV "{0}" was setup correctly'.format(config.isv))
-        except AwsError as e:
-            logging.error('Failed to setup S3 bucket: {0}'.format(e))
-            ret = 1
-        except OpenshiftError as e:
-            logging.error('Failed to setup openshift: {0}'.format(e))
-            ret = 1
-        except IOError as e:
-            logging.error('I/O error: {0}'.format(e))
-            ret = 1
+    logging.info('Running "{0}" action'.format(args.action))
+    action_kwargs = {'check_pulp': getattr(args, 'pulp', False), 'restart': getattr(args, 'restart', False),
+            'workers': getattr(args, 'workers', 4)}
+    if args.profile:
+        profiler = ActionProfiler(args.profile == 'memory')
+        ret = profiler.run(run_action, args.action, config, pulp, aws, openshift, **action_kwargs)
+        profiler.save(run_file('profiles', config.isv or 'redhat', args.action, '.prof'))
+        sys.stderr.write(profiler.summary())
+    else:
+        ret = run_action(args.action, config, pulp, aws, openshift, **action_kwargs)
 
-    elif args.action == 'publish':
-        try:
-            openshift.verify_domain()
-            openshift.verify_app()
-            openshift.clone_app()
-            pulp.download_repo(aws.app_url)
-            aws.upload_layers(pulp.files_for_aws(config.redhat_image_ids))
-            openshift.update_app([pulp.crane_config_file])
-            config.metafile = openshift.isv_app_crane_file
-            logging.info('Published "{0}" image'.format(config.isv_app_name))
-            stdprint('Published "{0}" image'.format(config.isv_app_name))
-            stdprint('To pull this image with docker, use:\n# docker pull {0}'.format(openshift.docker_pull_url()))
-            stdprint(openshift.docker_pull_url(), True)
-        except PulpError as e:
-            logging.error('Failed to download repo from pulp: {0}'.format(e))
-            ret = 1
-        except AwsError as e:
-            logging.error('Failed to upload images to AWS: {0}'.format(e))
-            ret = 1
-        except OpenshiftError as e:
-            logging.error('Failed to update openshift app: {0}'.format(e))
-            ret = 1
-        except IOError as e:
-            logging.error('I/O error: {0}'.format(e))
-            ret = 1
+    cleanup_backends(pulp, openshift)
 
-    elif args.action == 'pulp-upload':
+    if not args.nocommit:
         try:
-            pulp.upload_image(config.file_upload, config.redhat_image_ids)
-        except PulpError as e:
-            logging.error('Failed to upload image to pulp: {0}'.format(e))
+            config.commit_all_changes()
+        except ConfigurationError as e:
+            logging.error('Failed to commit configuration changes: {0}'.format(e))
             ret = 1
-        except IOError as e:
-            logging.error('I/O error: {0}'.format(e))
-            ret = 1
-
-    if args.action != 'pulp-upload':
-        openshift.cleanup()
-    pulp.cleanup()
-
-    if not args.nocommit:
-        config.commit_all_changes()
+    stats.save(report_file(config.isv or 'redhat', args.action), args.metrics, ret)
+    if args.stats:
+        stdprint(stats.summary())
+    config.cleanup()
 
     sys.exit(ret)
 